@@ -0,0 +1,103 @@
+"""
+Compares insert throughput of Database with and without bulk load mode.
+
+Both runs buffer --flush_size items per transaction, the number of commits is printed to check that they do.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from steam.sqlite import Database
+
+GENRES = ['Action', 'Adventure', 'Casual', 'Indie', 'RPG', 'Simulation', 'Strategy']
+SPECS = ['Single-player', 'Multi-player', 'Co-op', 'Steam Achievements', 'Steam Cloud']
+TAGS = ['Roguelike', 'Pixel Graphics', 'Difficult', 'Great Soundtrack', 'Open World', 'Story Rich', 'Puzzle']
+
+
+def generate_items(n_products, n_reviews):
+    """ Yields synthetic products, each followed by its reviews. """
+    random.seed(10)
+    for product_id in range(1, n_products + 1):
+        yield 'product', {
+            'id': product_id,
+            'title': f'Product {product_id}',
+            'developer': 'Developer',
+            'description_about': 'About this game. ' * 50,
+            'n_reviews': n_reviews,
+            'genres': random.sample(GENRES, 2),
+            'specs': random.sample(SPECS, 2),
+            'tags': random.sample(TAGS, 3)
+        }
+        for i in range(n_reviews):
+            yield 'review', {
+                'product_id': product_id,
+                'user_id': f'user{random.randint(0, 50 * n_products)}',
+                'page': i // 10,
+                'url': f'url{product_id}-{i // 10}',
+                'recommended': random.random() < 0.8,
+                'text': 'Great game, would play again. ' * random.randint(1, 20),
+                'hours': random.random() * 100
+            }
+
+
+class CommitCounter(Database):
+    """ Database that counts its commits. """
+    def __init__(self, *args, **kwargs):
+        self.commits = 0
+        super().__init__(*args, **kwargs)
+
+    def commit(self):
+        self.commits += 1
+        super().commit()
+
+
+def load(sqlite_path, items, bulk_load, flush_size):
+    """
+    Inserts items and returns the number of inserted rows, elapsed seconds (including index creation) and the number
+    of commits.
+    """
+    start = time.monotonic()
+    db = CommitCounter(sqlite_path, True, flush_size=flush_size, bulk_load=bulk_load)
+    for kind, item in items:
+        if kind == 'product':
+            db.add_product(item)
+        else:
+            db.add_review(item, '2020-01-01')
+            db.maybe_commit()
+    db.close()
+    elapsed = time.monotonic() - start
+    commits = db.commits
+
+    db = Database(sqlite_path, False)
+    tables = [name for name, in db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")]
+    rows = sum(db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables)
+    db.close()
+    return rows, elapsed, commits
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='BulkLoadBenchmark',
+                                     description='The script measures rows/sec with and without bulk load mode.')
+    parser.add_argument("--products", default=2000, type=int,
+                        help="Number of synthetic products.")
+    parser.add_argument("--reviews", default=50, type=int,
+                        help="Number of reviews per product.")
+    parser.add_argument("--flush_size", default=1000, type=int,
+                        help="Number of items written per transaction.")
+    parser.add_argument("--sqlite_dir", default=None, type=str,
+                        help="Directory for benchmark databases (defaults to a temporary directory).")
+    args = parser.parse_args()
+
+    items = list(generate_items(args.products, args.reviews))
+    with tempfile.TemporaryDirectory(dir=args.sqlite_dir) as tmp_dir:
+        for bulk_load in (False, True):
+            sqlite_path = os.path.join(tmp_dir, f'bulk_{bulk_load}.sqlite3')
+            rows, elapsed, commits = load(sqlite_path, items, bulk_load, args.flush_size)
+            print(f'bulk_load={bulk_load}: {rows} rows in {elapsed:.2f} s ({rows / elapsed:.0f} rows/sec), '
+                  f'{commits} commits')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Benchmarks the page parsers over the saved pages in fixtures/.
+
+For load_product, load_review and the lxml extractors it reports pages/sec and peak traced memory per page. For the
+loaders it also reports time per field, split into extraction (selectors and input processors) and output processing
+with the processors of steam/items.py.
+"""
+import argparse
+import glob
+import os
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+from itemloaders import ItemLoader
+
+from scripts.compare_extractors import product_response, review_response
+from steam.extractors import extract_product, extract_reviews
+from steam.spiders.product_spider import load_product
+from steam.spiders.review_spider import get_page, get_product_id, load_review
+
+
+def load_reviews(response):
+    product_id, page = get_product_id(response), get_page(response)
+    return [load_review(review, product_id, page, i, response)
+            for i, review in enumerate(response.css('div .apphub_Card'))]
+
+
+def extract_page_reviews(response):
+    return extract_reviews(response, get_product_id(response), get_page(response))
+
+
+# name: (fixture directory, response factory, parser)
+PARSERS = {
+    'load_product': ('product', product_response, load_product),
+    'extract_product': ('product', product_response, extract_product),
+    'load_review': ('review', review_response, load_reviews),
+    'extract_reviews': ('review', review_response, extract_page_reviews),
+}
+LOADERS = ['load_product', 'load_review']
+
+
+@contextmanager
+def field_timer(extract_time, output_time):
+    """ Adds seconds spent in ItemLoader calls to extract_time and output_time, keyed by field name. """
+    originals = {name: getattr(ItemLoader, name) for name in ('add_value', 'add_css', 'add_xpath', 'get_output_value')}
+    depth = [0]
+
+    def timed(method, times):
+        def wrapper(self, field_name, *args, **kwargs):
+            # add_css and add_xpath call add_value, only the outermost call is counted
+            depth[0] += 1
+            start = time.perf_counter()
+            try:
+                return method(self, field_name, *args, **kwargs)
+            finally:
+                depth[0] -= 1
+                if not depth[0]:
+                    times[field_name] += time.perf_counter() - start
+        return wrapper
+
+    for name, method in originals.items():
+        setattr(ItemLoader, name, timed(method, output_time if name == 'get_output_value' else extract_time))
+    try:
+        yield
+    finally:
+        for name, method in originals.items():
+            setattr(ItemLoader, name, method)
+
+
+def pages_per_second(responses, parser, repeat):
+    elapsed = 0
+    for _ in range(repeat):
+        for response in responses:
+            # a fresh copy, so that HTML parsing is measured as well
+            response = response.replace()
+            start = time.perf_counter()
+            parser(response)
+            elapsed += time.perf_counter() - start
+    return len(responses) * repeat / elapsed
+
+
+def peak_memory(responses, parser):
+    """ Average peak of memory allocated while parsing a page, in KiB. """
+    peaks = []
+    for response in responses:
+        response = response.replace()
+        tracemalloc.start()
+        parser(response)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return sum(peaks) / len(peaks) / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='ParserBenchmark',
+                                     description='The script measures page parsers on the saved pages in fixtures/.')
+    parser.add_argument("--fixtures_dir", default='fixtures', type=str,
+                        help="Directory with product/ and review/ pages.")
+    parser.add_argument("--repeat", default=20, type=int,
+                        help="Number of times every page is parsed.")
+    parser.add_argument("--parsers", nargs='*', default=list(PARSERS), choices=list(PARSERS),
+                        help="Parsers to benchmark.")
+    args = parser.parse_args()
+
+    responses = {}
+    for kind in ('product', 'review'):
+        factory = product_response if kind == 'product' else review_response
+        paths = sorted(glob.glob(os.path.join(args.fixtures_dir, kind, '*.html')))
+        responses[kind] = [factory(path) for path in paths]
+
+    print(f'{"parser":<16} {"pages":>6} {"pages/sec":>10} {"peak KiB/page":>14}')
+    for name in args.parsers:
+        kind, _, page_parser = PARSERS[name]
+        pages = responses[kind]
+        if not pages:
+            print(f'{name:<16} no pages in {os.path.join(args.fixtures_dir, kind)}')
+            continue
+        print(f'{name:<16} {len(pages):>6} {pages_per_second(pages, page_parser, args.repeat):>10.1f} '
+              f'{peak_memory(pages, page_parser):>14.1f}')
+
+    for name in [name for name in LOADERS if name in args.parsers]:
+        kind, _, page_parser = PARSERS[name]
+        pages = responses[kind]
+        if not pages:
+            continue
+        extract_time, output_time = Counter(), Counter()
+        with field_timer(extract_time, output_time):
+            for _ in range(args.repeat):
+                for response in pages:
+                    page_parser(response.replace())
+        n = len(pages) * args.repeat
+        print(f'\n{name}, microseconds per page')
+        print(f'{"field":<20} {"extract":>10} {"output":>10}')
+        for field in sorted(extract_time | output_time, key=lambda f: -(extract_time[f] + output_time[f])):
+            print(f'{field:<20} {extract_time[field] / n * 1e6:>10.1f} {output_time[field] / n * 1e6:>10.1f}')
+
+
+if __name__ == "__main__":
+    main()
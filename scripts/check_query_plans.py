@@ -0,0 +1,195 @@
+"""
+Checks that Database queries are supported by indexes.
+
+Every query method of Database runs against a synthetic database (iterators are read to the end) while
+`EXPLAIN QUERY PLAN` is recorded for each statement it executes; shard methods run against a second database seeded
+from it. Methods added to Database must be added to QUERIES or SHARD_QUERIES, or to the plumbing in NOT_QUERIES. The script exits with an error if a statement falls back to a full table
+scan, unless the method is expected to read that whole table.
+"""
+import argparse
+import inspect
+import os
+import random
+import re
+import sys
+import tempfile
+
+from steam.sqlite import Database
+
+# (method, args) for every query method of Database, in the order they run
+QUERIES = [
+    ('add_product', ({'id': 10 ** 6, 'title': 'Checked', 'n_reviews': 20, 'genres': ['Action', 'Indie'],
+                      'specs': ['Single-player'], 'tags': ['Roguelike']},)),
+    ('refresh_product', ({'id': 1, 'title': 'Refreshed', 'n_reviews': 60, 'genres': ['Action', 'RPG'],
+                          'specs': ['Co-op'], 'tags': ['Roguelike', 'Checked']},)),
+    ('get_product_ids', ()),
+    ('iter_products', ([1, 2, 3], 2)),
+    ('delete_partially_processed_reviews', ()),
+    ('get_last_urls_from_partially_processed_products', ()),
+    ('get_products_with_unprocessed_reviews', ()),
+    ('rebuild_crawl_progress', ()),
+    ('rebuild_review_stats', ()),
+    ('check_review_stats', ()),
+    ('get_products_to_refresh', ('2021-01-01',)),
+    ('get_max_review_id', ()),
+    ('get_review_id', (1, 'user1')),
+    ('get_review_ids', ()),
+    ('get_rscrape_ids', ()),
+    ('number_review_pages', ()),
+    ('update_rscrape_fails', (1,)),
+    ('get_user_ids', ()),
+    ('add_review_scraped', (1,)),
+    ('get_rscrape_id', ({'product_id': 1, 'page': 10 ** 6, 'url': 'url', 'status': 'OK', 'timestamp': None},)),
+    ('add_review', ({'product_id': 1, 'user_id': 'checked', 'page': 1, 'url': 'url'}, '2020-01-01')),
+    ('iter_reviews', (None, '2020-01-01', 100)),
+    ('get_tags', ()),
+    ('vocabulary_id', ('genre', 'Checked')),
+    ('get_products_without_news', ()),
+    ('get_latest_news_dates', ()),
+    ('add_news', ({'appid': 1, 'gid': '1', 'date': 1500000000, 'feedname': 'steam', 'feedlabel': 'Steam',
+                   'title': 'Checked', 'tags': ['checked']},)),
+    ('iter_news', ([1, 2, 3], '2017-01-01')),
+    ('create_search_index', (None,)),
+    ('search', ('review', 'fun')),
+    ('search_tables', ()),
+    ('rebuild_search_index', (['news'],)),
+    ('drop_search_index', (None,)),
+    ('add_dictionary', ('news.title', b'Checked news title dictionary')),
+    ('load_dictionaries', ()),
+]
+
+# methods that attach another database: seed_shard runs on a new shard database, merge_shard merges it back
+SHARD_QUERIES = ['seed_shard', 'merge_shard']
+
+# methods that only pass queries of other methods on, or run no queries of their own
+NOT_QUERIES = {'init', 'execute', 'queue', 'submit', 'commit', 'maybe_commit', 'next_id', 'add_column', 'compress',
+               'iterate', 'table_columns', 'close', 'bulk_load', 'start_bulk_load', 'finish_bulk_load'}
+
+# tables that a method reads completely on purpose
+FULL_SCANS = {
+    'add_product': {'genre', 'spec', 'tag'},
+    'refresh_product': {'genre', 'spec', 'tag'},
+    'add_review': {'sqlite_sequence'},
+    'add_news': {'ntag'},
+    'get_product_ids': {'product'},
+    'get_review_ids': {'review'},
+    'get_rscrape_ids': {'rscrape'},
+    'number_review_pages': {'rscrape'},
+    'get_user_ids': {'user'},
+    'rebuild_crawl_progress': {'product'},
+    'rebuild_review_stats': {'review'},
+    'check_review_stats': {'review', 'product_review_stats'},
+    'get_tags': {'ntag'},
+    'vocabulary_id': {'genre', 'spec', 'tag', 'ntag'},
+    'add_dictionary': {'compression_dictionary'},
+    'load_dictionaries': {'compression_dictionary'},
+    'seed_shard': {'product', 'compression_dictionary'},
+}
+
+SCAN_RE = re.compile(r'^SCAN (\w+)')
+
+
+class PlanRecorder(Database):
+    """ Database that records the query plan of every statement executed while a method is being checked. """
+    def __init__(self, *args, **kwargs):
+        self.method = None
+        self.plans = []
+        super().__init__(*args, **kwargs)
+
+    def record(self, query, params):
+        if self.method and not query.lstrip().upper().startswith('CREATE'):
+            plan = self.db.execute('EXPLAIN QUERY PLAN ' + query, params).fetchall()
+            self.plans.append((self.method, ' '.join(query.split()), [row[-1] for row in plan]))
+
+    def execute(self, query, params=(), *args, **kwargs):
+        self.record(query, params)
+        return super().execute(query, params, *args, **kwargs)
+
+    def queue(self, query, params):
+        self.record(query, params)
+        super().queue(query, params)
+
+
+def populate(db, n_products):
+    """ Fills database with random products, reviews and news. """
+    random.seed(10)
+    for product_id in range(1, n_products + 1):
+        db.add_product({
+            'id': product_id,
+            'title': f'Product {product_id}',
+            'n_reviews': random.choice([None, 5, 50, 500]),
+            'genres': random.sample(['Action', 'Indie', 'RPG', 'Strategy'], 2),
+            'specs': random.sample(['Single-player', 'Multi-player', 'Co-op'], 1),
+            'tags': random.sample(['Roguelike', 'Pixel Graphics', 'Difficult', 'Great Soundtrack'], 2)
+        })
+        for page in range(random.randint(0, 3)):
+            for order in range(5):
+                db.add_review({'product_id': product_id, 'user_id': f'user{random.randint(0, n_products)}',
+                               'page': page, 'url': f'url{product_id}-{page}', 'text': 'Fun.'}, '2020-01-01')
+        if random.random() < 0.5:
+            db.add_review_scraped(product_id, redirected=random.random() < 0.1)
+        for news in range(random.randint(0, 2)):
+            db.add_news({'appid': product_id, 'gid': f'{product_id}-{news}', 'date': 1500000000 + news,
+                         'feedname': 'steam', 'feedlabel': 'Steam', 'title': 'News', 'tags': ['patchnotes']})
+    db.commit()
+
+
+def query_methods():
+    """ Names of all methods of Database that run queries, schema methods (create_*) aside. """
+    return {name for name, _ in inspect.getmembers(Database, inspect.isfunction)
+            if not name.startswith('_') and not name.startswith('create_') and name not in NOT_QUERIES}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='QueryPlanChecker',
+                                     description='The script checks that Database queries do not scan whole tables.')
+    parser.add_argument("--products", default=1000, type=int,
+                        help="Number of products in the synthetic database.")
+    parser.add_argument("--verbose", action='store_true',
+                        help="Print query plans of all statements.")
+    args = parser.parse_args()
+
+    missing = query_methods() - {name for name, _ in QUERIES} - set(SHARD_QUERIES)
+    if missing:
+        print(f'Query methods missing from the check: {", ".join(sorted(missing))}')
+        return 1
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path, shard_path = os.path.join(tmp_dir, 'plans.sqlite3'), os.path.join(tmp_dir, 'plans.shard.sqlite3')
+        db = PlanRecorder(db_path, True)
+        populate(db, args.products)
+        tables = {name for name, in db.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+
+        for name, method_args in QUERIES:
+            db.method = name
+            result = getattr(db, name)(*method_args)
+            if inspect.isgenerator(result):
+                list(result)
+            db.method = None
+
+        db.commit()
+        shard = PlanRecorder(shard_path, True)
+        shard.plans = db.plans
+        for recorder, name, method_args in zip((shard, db), SHARD_QUERIES, ((db_path, 0, 2), (shard_path,))):
+            recorder.method = name
+            getattr(recorder, name)(*method_args)
+            recorder.method = None
+        shard.close()
+        db.close()
+
+    failed = 0
+    for method, query, plan in db.plans:
+        scans = {m.group(1) for m in map(SCAN_RE.match, plan) if m and m.group(1) in tables}
+        scans -= FULL_SCANS.get(method, set())
+        if scans or args.verbose:
+            print(f'{"FULL SCAN" if scans else "OK"} {method}: {query}')
+            for detail in plan:
+                print(f'    {detail}')
+        failed += bool(scans)
+
+    print(f'{len(db.plans)} statements checked, {failed} with full table scans.')
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
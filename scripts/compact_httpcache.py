@@ -0,0 +1,75 @@
+"""
+Maintains the SQLite HTTP cache of SteamSQLiteCacheStorage.
+
+Deletes expired responses and compacts the file with VACUUM. With --import_dir, responses of a filesystem cache
+written by SteamCacheStorage (<HTTPCACHE_DIR>/<spider>) are imported first, so a crawl can switch storages without
+downloading everything again.
+"""
+import argparse
+import os
+import pickle
+import time
+import zlib
+
+from steam.middlewares import SteamSQLiteCacheStorage
+
+
+def import_filesystem_cache(db, cache_dir):
+    """ Imports responses stored by FilesystemCacheStorage in cache_dir and returns their number. """
+    query = """
+    INSERT OR IGNORE INTO response (fingerprint, timestamp, url, status, headers, body)
+    VALUES (?, ?, ?, ?, ?, ?)
+    """
+    imported = 0
+    for prefix in sorted(os.listdir(cache_dir)):
+        for key in sorted(os.listdir(os.path.join(cache_dir, prefix))):
+            path = os.path.join(cache_dir, prefix, key)
+            try:
+                with open(os.path.join(path, 'pickled_meta'), 'rb') as f:
+                    meta = pickle.load(f)
+                with open(os.path.join(path, 'response_headers'), 'rb') as f:
+                    headers = f.read()
+                with open(os.path.join(path, 'response_body'), 'rb') as f:
+                    body = f.read()
+            except (OSError, pickle.UnpicklingError):
+                continue
+            timestamp = os.stat(os.path.join(path, 'pickled_meta')).st_mtime
+            db.execute(query, (bytes.fromhex(key), timestamp, meta.get('response_url'), meta['status'], headers,
+                               zlib.compress(body)))
+            imported += 1
+        db.commit()
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='HTTPCacheCompactor',
+                                     description='The script expires and compacts the SQLite HTTP cache.')
+    parser.add_argument("--cache_path", default='.scrapy/httpcache/reviews.sqlite3', type=str,
+                        help="Path to the cache file, <HTTPCACHE_DIR>/<spider>.sqlite3.")
+    parser.add_argument("--expiration_secs", default=0, type=int,
+                        help="Delete responses older than this, 0 keeps all responses.")
+    parser.add_argument("--import_dir", default=None, type=str,
+                        help="Filesystem cache directory of the same spider to import, <HTTPCACHE_DIR>/<spider>.")
+    args = parser.parse_args()
+
+    db = SteamSQLiteCacheStorage.connect(args.cache_path)
+    if args.import_dir:
+        start_time = time.time()
+        imported = import_filesystem_cache(db, args.import_dir)
+        print(f'{imported} responses imported in {time.time() - start_time:.2f} seconds')
+
+    deleted = SteamSQLiteCacheStorage.delete_expired(db, args.expiration_secs)
+    print(f'{deleted} expired responses deleted')
+
+    size = os.path.getsize(args.cache_path)
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.execute("VACUUM")
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    n_responses, body_bytes = db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0) FROM response").fetchone()
+    db.close()
+    print(f'{n_responses} responses, {body_bytes / 2 ** 20:.1f} MiB of compressed bodies, '
+          f'file {size / 2 ** 20:.1f} MiB -> {os.path.getsize(args.cache_path) / 2 ** 20:.1f} MiB')
+
+
+if __name__ == "__main__":
+    main()
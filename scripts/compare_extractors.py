@@ -0,0 +1,99 @@
+"""
+Checks that the lxml extractors of steam/extractors.py produce the same items as the item loaders.
+
+Saved product pages are named after their app id, e.g. 416600.html, review pages after the app id and page number,
+e.g. 416600-p1.html for the first reviews page and 416600-p2.html for the second page loaded through homecontent.
+Without arguments the pages in fixtures/ are compared. The script fails if pages differ or no page was compared.
+"""
+import argparse
+import glob
+import os
+import sys
+
+from scrapy.http import HtmlResponse, Request
+
+from steam.extractors import extract_product, extract_reviews
+from steam.spiders.product_spider import load_product
+from steam.spiders.review_spider import get_page, get_product_id, load_review
+
+
+def product_response(path):
+    """ Response for a saved product page, with the store URL of the app id in the file name. """
+    product_id = os.path.splitext(os.path.basename(path))[0]
+    with open(path, 'rb') as f:
+        body = f.read()
+    return HtmlResponse(url=f'https://store.steampowered.com/app/{product_id}/', body=body, encoding='utf-8')
+
+
+def review_response(path):
+    """ Response for a saved review page, as ReviewSpider requests the page in the file name. """
+    product_id, page = os.path.splitext(os.path.basename(path))[0].split('-p')
+    if page == '1':
+        url = f'https://steamcommunity.com/app/{product_id}/reviews/?browsefilter=mostrecent&p=1'
+        meta = {}
+    else:
+        url = (f'https://steamcommunity.com/app/{product_id}/homecontent/'
+               f'?userreviewsoffset={10 * (int(page) - 1)}&p={page}&browsefilter=mostrecent&appid={product_id}')
+        meta = {'prev_page': int(page) - 1, 'product_id': product_id}
+    with open(path, 'rb') as f:
+        body = f.read()
+    return HtmlResponse(url=url, body=body, encoding='utf-8', request=Request(url, meta=meta))
+
+
+def compare(expected, actual):
+    """ Returns [(field, expected value, actual value)] for fields that differ. """
+    fields = list(expected) + [field for field in actual if field not in expected]
+    return [(field, expected.get(field), actual.get(field)) for field in fields
+            if expected.get(field) != actual.get(field)]
+
+
+def compare_product(path):
+    response = product_response(path)
+    return compare(dict(load_product(response)), dict(extract_product(response)))
+
+
+def compare_reviews(path):
+    response = review_response(path)
+    product_id, page = get_product_id(response), get_page(response)
+    expected = [dict(load_review(review, product_id, page, i, response))
+                for i, review in enumerate(response.css('div .apphub_Card'))]
+    actual = extract_reviews(response, product_id, page)
+    if len(expected) != len(actual):
+        return [('cards', len(expected), len(actual))]
+    return [(f'{i}.{field}', e, a) for i, (review, record) in enumerate(zip(expected, actual))
+            for field, e, a in compare(review, record)]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='ExtractorComparison',
+                                     description='The script compares items of the lxml extractors and the loaders.')
+    parser.add_argument("--product_pages", nargs='*', default=None, type=str,
+                        help="Saved product pages, named <app id>.html (default: fixtures/product/*.html).")
+    parser.add_argument("--review_pages", nargs='*', default=None, type=str,
+                        help="Saved review pages, named <app id>-p<page>.html (default: fixtures/review/*.html).")
+    parser.add_argument("--fixtures_dir", default='fixtures', type=str,
+                        help="Directory with product/ and review/ pages used when no pages are given.")
+    args = parser.parse_args()
+    if args.product_pages is None and args.review_pages is None:
+        args.product_pages = sorted(glob.glob(os.path.join(args.fixtures_dir, 'product', '*.html')))
+        args.review_pages = sorted(glob.glob(os.path.join(args.fixtures_dir, 'review', '*.html')))
+
+    pages = [(path, compare_product) for path in args.product_pages or []]
+    pages += [(path, compare_reviews) for path in args.review_pages or []]
+    if not pages:
+        print('No pages to compare.')
+        return 1
+    failed = 0
+    for path, compare_page in pages:
+        differences = compare_page(path)
+        print(f'{"DIFFERENT" if differences else "OK"} {path}')
+        for field, expected, actual in differences:
+            print(f'    {field}: {expected!r} != {actual!r}')
+        failed += bool(differences)
+
+    print(f'{len(pages)} pages compared, {failed} with differences.')
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
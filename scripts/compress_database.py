@@ -0,0 +1,102 @@
+"""
+Compresses the large text columns of an existing database (review text, news contents and product descriptions).
+
+For every column a zlib preset dictionary is built from a sample of its values and stored in the database, then all
+values are rewritten, batch by batch. Later writes through Database are compressed with the same dictionaries. With
+--decompress all values are written back as plain text and the dictionaries are removed. Run it while no crawl
+writes to the database.
+
+Database size and the time of a full scan of every column (a LIKE search through decompress) are reported before
+and after.
+"""
+import argparse
+import os
+import time
+
+from steam.compression import COMPRESSED_COLUMNS, MAX_DICTIONARY_SIZE, train_dictionary
+from steam.sqlite import Database
+
+
+def scan_time(db, table, column):
+    """ Seconds of a search through all values of column. """
+    start_time = time.time()
+    db.execute(f"SELECT COUNT(*) FROM {table} WHERE decompress({column}) LIKE '%steam%'").fetchone()
+    return time.time() - start_time
+
+
+def column_bytes(db, table, column):
+    """ Bytes stored in column. """
+    return db.execute(f"SELECT COALESCE(SUM(LENGTH(CAST({column} AS BLOB))), 0) FROM {table}").fetchone()[0]
+
+
+def rewrite(db, table, column, batch_size, compress=True):
+    """ Stores all values of column again, compressed with the column's dictionary or as plain text. """
+    last_id = -1
+    rewritten = 0
+    query = f"SELECT id, decompress({column}) FROM {table} WHERE id > ? AND {column} IS NOT NULL ORDER BY id LIMIT ?"
+    while True:
+        rows = db.execute(query, (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        values = [(db.compress(f'{table}.{column}', text) if compress else text, row_id) for row_id, text in rows]
+        db.db.executemany(f"UPDATE {table} SET {column}=? WHERE id=?", values)
+        db.commit()
+        last_id = rows[-1][0]
+        rewritten += len(rows)
+    return rewritten
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='DatabaseCompressor',
+                                     description='The script compresses text columns of an existing database.')
+    parser.add_argument("--sqlite_path", default='output/db.sqlite3', type=str,
+                        help="Path to the database.")
+    parser.add_argument("--columns", nargs='*', default=[f'{t}.{c}' for t, c in COMPRESSED_COLUMNS],
+                        choices=[f'{t}.{c}' for t, c in COMPRESSED_COLUMNS],
+                        help="Columns to compress, as table.column.")
+    parser.add_argument("--sample_size", default=20000, type=int,
+                        help="Number of values a dictionary is built from.")
+    parser.add_argument("--dictionary_size", default=MAX_DICTIONARY_SIZE, type=int,
+                        help="Maximal dictionary size in bytes.")
+    parser.add_argument("--batch_size", default=10000, type=int,
+                        help="Number of rows rewritten per transaction.")
+    parser.add_argument("--decompress", action='store_true',
+                        help="Store the columns as plain text again.")
+    args = parser.parse_args()
+
+    db = Database(args.sqlite_path, False)
+    columns = [tuple(column.split('.')) for column in args.columns]
+    before = {(table, column): (column_bytes(db, table, column), scan_time(db, table, column))
+              for table, column in columns}
+    size = os.path.getsize(args.sqlite_path)
+
+    for table, column in columns:
+        start_time = time.time()
+        if args.decompress:
+            rewritten = rewrite(db, table, column, args.batch_size, compress=False)
+        else:
+            query = f"SELECT decompress({column}) FROM {table} WHERE {column} IS NOT NULL ORDER BY RANDOM() LIMIT ?"
+            samples = [text for text, in db.execute(query, (args.sample_size,))]
+            db.add_dictionary(f'{table}.{column}', train_dictionary(samples, args.dictionary_size))
+            rewritten = rewrite(db, table, column, args.batch_size)
+        # no value references the column's other dictionaries anymore
+        db.execute("DELETE FROM compression_dictionary WHERE column_name=? AND id IS NOT ?",
+                   (f'{table}.{column}', None if args.decompress else db.compressor.active[f'{table}.{column}']))
+        db.commit()
+        db.load_dictionaries()
+        print(f'{table}.{column}: {rewritten} values rewritten in {time.time() - start_time:.2f} seconds')
+    db.commit()
+    db.execute("VACUUM")
+
+    print(f'{"column":<30} {"MiB before":>11} {"MiB after":>10} {"scan s before":>14} {"scan s after":>13}')
+    for table, column in columns:
+        bytes_before, time_before = before[(table, column)]
+        print(f'{table + "." + column:<30} {bytes_before / 2 ** 20:>11.1f} '
+              f'{column_bytes(db, table, column) / 2 ** 20:>10.1f} {time_before:>14.2f} '
+              f'{scan_time(db, table, column):>13.2f}')
+    db.close()
+    print(f'database {size / 2 ** 20:.1f} MiB -> {os.path.getsize(args.sqlite_path) / 2 ** 20:.1f} MiB')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+Streams tables and denormalized views of the database to CSV, JSON lines, Parquet or Arrow files.
+
+Rows are read in batches of --batch_size with fetchmany and written as they come (one row group per batch for
+Parquet), so memory use does not depend on the size of the export. Compressed text columns are exported decompressed.
+With --workers, exports that can be split by product id are written in parallel, one file per product id range.
+Parquet and Arrow output needs pyarrow (pip install pyarrow). The database is opened read-only.
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+
+from steam.compression import COMPRESSED_COLUMNS, Compressor
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def links(table):
+    return (f"(SELECT group_concat({table}.name, ', ') FROM product_{table} JOIN {table} "
+            f"ON {table}.id == product_{table}.{table}_id WHERE product_{table}.product_id == product.id)")
+
+
+# name: (FROM clause, product id column the export is split on, [(column, expression, declared type)])
+VIEWS = {
+    'reviews': (
+        "review JOIN product ON product.id == review.product_id LEFT JOIN user ON user.id == review.user_id",
+        'review.product_id',
+        [('id', 'review.id', 'INTEGER'), ('product_id', 'review.product_id', 'INTEGER'),
+         ('app_name', 'product.app_name', 'TEXT'), ('product_title', 'product.title', 'TEXT'),
+         ('user_id', 'review.user_id', 'TEXT'), ('username', 'user.username', 'TEXT'),
+         ('user_products', 'user.products', 'INTEGER'), ('recommended', 'review.recommended', 'TEXT'),
+         ('date', 'review.date', 'TEXT'), ('text', 'decompress(review.text)', 'TEXT'),
+         ('hours', 'review.hours', 'REAL'), ('found_helpful', 'review.found_helpful', 'INTEGER'),
+         ('found_funny', 'review.found_funny', 'INTEGER'), ('found_awarding', 'review.found_awarding', 'TEXT'),
+         ('early_access', 'review.early_access', 'BOOLEAN'), ('compensation', 'review.compensation', 'TEXT')]),
+    'products': (
+        "product",
+        'product.id',
+        [('id', 'product.id', 'INTEGER'), ('app_name', 'app_name', 'TEXT'), ('title', 'title', 'TEXT'),
+         ('developer', 'developer', 'TEXT'), ('publisher', 'publisher', 'TEXT'),
+         ('release_date', 'release_date', 'TEXT'), ('genres', links('genre'), 'TEXT'),
+         ('specs', links('spec'), 'TEXT'), ('tags', links('tag'), 'TEXT'), ('price', 'price', 'REAL'),
+         ('discount_price', 'discount_price', 'REAL'), ('sentiment', 'sentiment', 'TEXT'),
+         ('n_reviews', 'n_reviews', 'INTEGER'), ('metascore', 'metascore', 'REAL'),
+         ('early_access', 'early_access', 'BOOLEAN'), ('url', 'url', 'TEXT'),
+         ('reviews_url', 'reviews_url', 'TEXT'), ('news_url', 'news_url', 'TEXT'),
+         ('description_about', 'decompress(description_about)', 'TEXT'),
+         ('description_reviews', 'decompress(description_reviews)', 'TEXT'),
+         ('reviews_scraped', 'reviews_scraped', 'TEXT')]),
+    'news': (
+        "news JOIN product ON product.id == news.product_id",
+        'news.product_id',
+        [('id', 'news.id', 'INTEGER'), ('gid', 'news.gid', 'TEXT'), ('product_id', 'news.product_id', 'INTEGER'),
+         ('app_name', 'product.app_name', 'TEXT'), ('title', 'news.title', 'TEXT'),
+         ('author', 'news.author', 'TEXT'), ('date', 'news.date', 'TEXT'),
+         ('feed_name', 'news.feed_name', 'TEXT'), ('feed_label', 'news.feed_label', 'TEXT'),
+         ('feed_type', 'news.feed_type', 'INTEGER'),
+         ('tags', "(SELECT group_concat(ntag.name, ', ') FROM news_ntag JOIN ntag ON ntag.id == news_ntag.ntag_id "
+                  "WHERE news_ntag.news_id == news.id)", 'TEXT'),
+         ('contents', 'decompress(news.contents)', 'TEXT')]),
+}
+EXTENSIONS = {'csv': 'csv', 'jsonl': 'jsonl', 'parquet': 'parquet', 'arrow': 'arrow'}
+# declared types whose values are exported as stored, values of other columns are cast to text
+KEPT_TYPES = ('INTEGER', 'BOOLEAN', 'REAL', 'BLOB')
+# formats with a typed schema
+TYPED_FORMATS = ('parquet', 'arrow')
+# value of a column of a kept type in typed formats, values of other types (e.g. 'Free to Play' in price) become NULL
+TYPED_VALUES = {
+    'INTEGER': "CASE typeof({0}) WHEN 'integer' THEN {0} WHEN 'real' THEN CAST({0} AS INTEGER) END",
+    'BOOLEAN': "CASE typeof({0}) WHEN 'integer' THEN {0} WHEN 'real' THEN CAST({0} AS INTEGER) END",
+    'REAL': "CASE WHEN typeof({0}) IN ('integer', 'real') THEN CAST({0} AS REAL) END",
+    'BLOB': "CASE WHEN {0} IS NULL THEN NULL ELSE CAST({0} AS BLOB) END",
+}
+
+
+def connect(sqlite_path):
+    """ Opens the database read-only, with the decompress() function of its compression dictionaries. """
+    db = sqlite3.connect(f'file:{sqlite_path}?mode=ro', uri=True)
+    compressor = Compressor()
+    if db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='compression_dictionary'").fetchone():
+        compressor.load(db.execute("SELECT id, column_name, data FROM compression_dictionary").fetchall())
+    db.create_function('decompress', 1, compressor.decompress, deterministic=True)
+    return db
+
+
+def table_export(db, table):
+    """ Export definition of a table, like the entries of VIEWS. """
+    compressed = {column for t, column in COMPRESSED_COLUMNS if t == table}
+    columns = [(name, f'decompress({name})' if name in compressed else name, declared.upper())
+               for _, name, declared, *_ in db.execute(f"PRAGMA table_info({table})")]
+    names = [name for name, _, _ in columns]
+    split_column = 'id' if table == 'product' else 'product_id' if 'product_id' in names else None
+    return table, split_column, columns
+
+
+def select_query(source, split_column, columns, product_range, file_format):
+    """
+    Query of an export in a product id range. Every column gets values of a single type in typed formats, text
+    formats keep values of other types in columns of kept types.
+    """
+    expressions = [(TYPED_VALUES[declared].format(expression) if file_format in TYPED_FORMATS else expression)
+                   if declared in KEPT_TYPES else f'CAST({expression} AS TEXT)' for _, expression, declared in columns]
+    query = f"SELECT {', '.join(expressions)} FROM {source}"
+    low, high = product_range
+    conditions = ([f'{split_column} >= {low}'] if low is not None else []) + \
+                 ([f'{split_column} < {high}'] if high is not None else [])
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    return query
+
+
+class CsvWriter:
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([name for name, _, _ in columns])
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class JsonLinesWriter:
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.names = [name for name, _, _ in columns]
+
+    def write(self, rows):
+        self.file.writelines(json.dumps(dict(zip(self.names, row)), ensure_ascii=False) + '\n' for row in rows)
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowWriter:
+    """ Writes a Parquet file with a row group per batch, or an Arrow IPC file with a record batch per batch. """
+    def __init__(self, path, columns, file_format):
+        types = {'INTEGER': pyarrow.int64(), 'BOOLEAN': pyarrow.int64(), 'REAL': pyarrow.float64(),
+                 'BLOB': pyarrow.binary()}
+        self.schema = pyarrow.schema([(name, types.get(declared, pyarrow.string())) for name, _, declared in columns])
+        if file_format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='zstd')
+        else:
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+        self.file_format = file_format
+
+    def write(self, rows):
+        arrays = [pyarrow.array(values, type=field.type) for values, field in zip(zip(*rows), self.schema)]
+        batch = pyarrow.record_batch(arrays, schema=self.schema)
+        if self.file_format == 'parquet':
+            self.writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+
+
+def open_writer(path, columns, file_format):
+    if file_format == 'csv':
+        return CsvWriter(path, columns)
+    if file_format == 'jsonl':
+        return JsonLinesWriter(path, columns)
+    return ArrowWriter(path, columns, file_format)
+
+
+def export_part(job):
+    """ Writes rows of an export in a product id range to path, returns (path, rows, seconds). """
+    sqlite_path, export, product_range, path, file_format, batch_size = job
+    start_time = time.time()
+    db = connect(sqlite_path)
+    source, split_column, columns = VIEWS[export] if export in VIEWS else table_export(db, export)
+    cursor = db.execute(select_query(source, split_column, columns, product_range, file_format))
+    writer = open_writer(path, columns, file_format)
+    n_rows = 0
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            writer.write(rows)
+            n_rows += len(rows)
+    finally:
+        writer.close()
+        db.close()
+    return path, n_rows, time.time() - start_time
+
+
+def product_ranges(db, parts):
+    """ Splits product ids into parts ranges [low, high) with about the same number of products. """
+    n_products = db.execute("SELECT COUNT(*) FROM product").fetchone()[0]
+    query = "SELECT id FROM product ORDER BY id LIMIT 1 OFFSET ?"
+    bounds = sorted({db.execute(query, (n_products * i // parts,)).fetchone()[0] for i in range(1, parts)}
+                    if n_products >= parts else set())
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='DatabaseExporter',
+                                     description='The script streams tables and views of the database to files.')
+    parser.add_argument("--sqlite_path", default='output/db.sqlite3', type=str,
+                        help="Path to the database.")
+    parser.add_argument("--exports", nargs='*', default=list(VIEWS),
+                        help=f"Views ({', '.join(VIEWS)}) or tables to export.")
+    parser.add_argument("--format", default='csv', choices=list(EXTENSIONS),
+                        help="Output format, parquet and arrow need pyarrow.")
+    parser.add_argument("--output_dir", default='output/export', type=str,
+                        help="Directory the files are written to, <export>.<format> or <export>-<part>.<format>.")
+    parser.add_argument("--batch_size", default=10000, type=int,
+                        help="Rows read and written at a time, also the Parquet row group size.")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="Number of processes, exports with a product id are split into as many files.")
+    args = parser.parse_args()
+
+    if args.format in ('parquet', 'arrow') and pyarrow is None:
+        parser.error(f'{args.format} output needs pyarrow, install it with pip install pyarrow')
+
+    if not os.path.exists(args.sqlite_path):
+        parser.error(f'database {args.sqlite_path} does not exist')
+    db = connect(args.sqlite_path)
+    tables = {name for name, in db.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    unknown = [export for export in args.exports if export not in VIEWS and export not in tables]
+    if unknown:
+        parser.error(f'unknown exports: {", ".join(unknown)}')
+    ranges = product_ranges(db, args.workers)
+    split = {export: (VIEWS[export] if export in VIEWS else table_export(db, export))[1] for export in args.exports}
+    db.close()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    jobs = []
+    for export in args.exports:
+        export_ranges = ranges if split[export] and len(ranges) > 1 else [(None, None)]
+        for part, product_range in enumerate(export_ranges):
+            name = f'{export}-{part:03d}' if len(export_ranges) > 1 else export
+            path = os.path.join(args.output_dir, f'{name}.{EXTENSIONS[args.format]}')
+            jobs.append((args.sqlite_path, export, product_range, path, args.format, args.batch_size))
+
+    start_time = time.time()
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers) as pool:
+            results = list(pool.imap_unordered(export_part, jobs))
+    else:
+        results = map(export_part, jobs)
+    for path, n_rows, seconds in results:
+        print(f'{path}: {n_rows} rows in {seconds:.2f} seconds')
+    print(f'Exported in {time.time() - start_time:.2f} seconds.')
+
+
+if __name__ == "__main__":
+    main()
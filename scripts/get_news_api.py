@@ -1,13 +1,23 @@
+import http.client
 import sys
+import urllib.error
+import urllib.parse
 import urllib.request
 import json
 import argparse
+import datetime as dt
+import random
+import threading
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from steam.sqlite import Database
 from tqdm import tqdm
 logging.basicConfig(level=logging.INFO)
 
+API_URL = 'http://api.steampowered.com/ISteamNews/GetNewsForApp/v0002/'
+RETRY_HTTP_CODES = {429, 500, 502, 503, 504}
+
 
 def parse_args(args):
     parser = argparse.ArgumentParser(prog='NewsAPIScraper',
@@ -16,29 +26,165 @@ def parse_args(args):
                         help="Path to database file.")
     parser.add_argument("--api_key", default=None, type=str,
                         help="API key. It is not necessary for the script to work.")
+    parser.add_argument("--api_url", default=API_URL, type=str,
+                        help="GetNewsForApp endpoint, can point to a local server for testing.")
+    parser.add_argument("--workers", default=8, type=int,
+                        help="Maximum number of requests in flight.")
+    parser.add_argument("--rate", default=10.0, type=float,
+                        help="Maximum number of requests per second.")
+    parser.add_argument("--retries", default=5, type=int,
+                        help="Number of retries on HTTP 429/5xx and connection errors.")
+    parser.add_argument("--backoff", default=1.0, type=float,
+                        help="Initial retry delay in seconds, doubled on every retry.")
+    parser.add_argument("--timeout", default=30.0, type=float,
+                        help="Request timeout in seconds.")
+    parser.add_argument("--commit_every", default=50, type=int,
+                        help="Number of products written per transaction.")
+    parser.add_argument("--incremental", action='store_true',
+                        help="Fetch only news newer than the newest stored news of every product with reviews.")
+    parser.add_argument("--page_size", default=20, type=int,
+                        help="Number of news requested per call in incremental mode.")
     return parser.parse_args(args)
 
 
+class TokenBucket:
+    """ Thread-safe token bucket allowing `rate` acquisitions per second with bursts of up to `capacity`. """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Blocks until a token is available. """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+def news_url(api_url, product_id, api_key=None, count=20000, enddate=None):
+    params = {'appid': product_id, 'count': count, 'maxlength': 20000, 'format': 'json'}
+    if enddate:
+        params['enddate'] = enddate
+    if api_key:
+        params['key'] = api_key
+    return f'{api_url}?{urllib.parse.urlencode(params)}'
+
+
+def fetch_news(url_string, bucket, retries=5, backoff=1.0, timeout=30.0):
+    """
+    Returns news items from url_string, retrying with exponential backoff; None if the request failed. Truncated or
+    invalid JSON responses are retried as well, a response without news items is not.
+    """
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        delay = backoff * 2 ** attempt * (1 + random.random() / 2)
+        try:
+            with urllib.request.urlopen(url_string, timeout=timeout) as url:
+                data = json.load(url)
+            return data['appnews']['newsitems']
+        except (KeyError, TypeError):
+            logging.warning(f'Unexpected response: {url_string}')
+            return None
+        except urllib.error.HTTPError as e:
+            if e.code not in RETRY_HTTP_CODES:
+                logging.warning(f'Could not access ({e.code}): {url_string}')
+                return None
+            retry_after = e.headers.get('Retry-After') if e.headers else None
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+        except (urllib.error.URLError, http.client.HTTPException, ValueError, TimeoutError, ConnectionError):
+            # ValueError covers bodies that are cut off or not JSON
+            pass
+        if attempt < retries:
+            time.sleep(delay)
+    logging.warning(f'Could not access after {retries} retries: {url_string}')
+    return None
+
+
+def fetch_newer_news(product_id, newest, args, bucket):
+    """
+    Returns news of product published at or after newest (unix time). News come newest first, so pages are requested
+    backwards in time with enddate until older news show up. News from the second of newest are fetched again, as
+    others may have been published in the same second; they are stored by gid, so this adds no duplicates. Returns
+    None if a request failed.
+    """
+    news, seen, enddate = [], set(), None
+    while True:
+        url_string = news_url(args.api_url, product_id, args.api_key, args.page_size, enddate)
+        items = fetch_news(url_string, bucket, args.retries, args.backoff, args.timeout)
+        if items is None:
+            return None
+        new_items = [item for item in items if item['date'] >= newest and item.get('gid') not in seen]
+        news += new_items
+        seen.update(item.get('gid') for item in new_items)
+        # pages overlap at enddate, so news already seen do not end the search, only older news or a short page do
+        if len(items) < args.page_size or any(item['date'] < newest for item in items):
+            return news
+        # a full page of news seen before, all from the second of enddate, cannot be paged through by date
+        enddate = min(item['date'] for item in items) - (not new_items)
+
+
+def to_timestamp(date):
+    """ Converts a stored news date to unix time. """
+    return int(dt.datetime.fromisoformat(date).replace(tzinfo=dt.timezone.utc).timestamp())
+
+
 def main():
     args = parse_args(sys.argv[1:])
     db = Database(args.sqlite_path, False)
-    reviews_scraped = db.get_products_without_news()
-    tags = db.get_tags()
-
-    for i, product_id in tqdm(enumerate(reviews_scraped), total=len(reviews_scraped)):
-        if args.api_key:
-            url_string = f"http://api.steampowered.com/ISteamNews/GetNewsForApp/v0002/?key={args.api_key}&appid={product_id}&count=20000&maxlength=20000&format=json"
-        else:
-            url_string = f"http://api.steampowered.com/ISteamNews/GetNewsForApp/v0002/?appid={product_id}&count=20000&maxlength=20000&format=json"
+    if args.incremental:
+        reviews_scraped = [(p_id, to_timestamp(date) if date else None) for p_id, date in db.get_latest_news_dates()]
+    else:
+        reviews_scraped = [(p_id, None) for p_id in db.get_products_without_news()]
+    bucket = TokenBucket(args.rate, capacity=args.workers)
+
+    def fetch(product):
+        product_id, newest = product
         try:
-            with urllib.request.urlopen(url_string) as url:
-                data = json.load(url)
-                for item in data['appnews']['newsitems']:
-                    db.add_news(item, tags)
-                db.commit()
-        except urllib.error.HTTPError:
-            logging.warning(logging.WARNING, f'Could not access: {url_string}')
-        time.sleep(0.1)
+            if newest is not None:
+                return product_id, fetch_newer_news(product_id, newest, args, bucket)
+            url_string = news_url(args.api_url, product_id, args.api_key)
+            return product_id, fetch_news(url_string, bucket, args.retries, args.backoff, args.timeout)
+        except (KeyError, TypeError, ValueError) as e:
+            # a malformed news item fails only its product
+            logging.warning(f'Could not read news of product {product_id}: {e!r}')
+            return product_id, None
+
+    # keep a bounded number of products in flight, results are written from this thread only
+    products = iter(reviews_scraped)
+    written = failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor, tqdm(total=len(reviews_scraped)) as progress:
+        in_flight = {executor.submit(fetch, product) for _, product in zip(range(2 * args.workers), products)}
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                product_id, items = future.result()
+                if items is None:
+                    failed += 1
+                for item in items or []:
+                    try:
+                        db.add_news(item)
+                    except (KeyError, TypeError, ValueError) as e:
+                        logging.warning(f'Skipped malformed news item of product {product_id}: {e!r}')
+                written += 1
+                if written % args.commit_every == 0:
+                    db.commit()
+                progress.update()
+                next_product = next(products, None)
+                if next_product is not None:
+                    in_flight.add(executor.submit(fetch, next_product))
+    db.close()
+    if failed:
+        logging.warning(f'News of {failed} of {len(reviews_scraped)} products could not be fetched')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,40 @@
+"""
+Merges the databases written by a sharded review crawl (ReviewSpider with shard_index and shard_count) back into the
+main database.
+"""
+import argparse
+import glob
+import os
+import time
+
+from steam.sqlite import Database
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='ShardMerger',
+                                     description='The script merges review crawl shards into the main database.')
+    parser.add_argument("--sqlite_path", default='output/db.sqlite3', type=str,
+                        help="Path to the main database.")
+    parser.add_argument("--shard_paths", nargs='*', default=None, type=str,
+                        help="Shard databases to merge, by default all <sqlite_path root>.shard*of*<ext> files.")
+    args = parser.parse_args()
+
+    shard_paths = args.shard_paths
+    if shard_paths is None:
+        root, ext = os.path.splitext(args.sqlite_path)
+        shard_paths = sorted(glob.glob(f'{glob.escape(root)}.shard*of*{ext}'))
+    if not shard_paths:
+        print('No shards to merge.')
+        return
+
+    db = Database(args.sqlite_path, False)
+    for path in shard_paths:
+        start_time = time.time()
+        written = db.merge_shard(path)
+        print(f'{path} merged in {time.time() - start_time:.2f} seconds: '
+              + ', '.join(f'{rows} {table}' for table, rows in written.items()))
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,105 @@
-import random
 import argparse
+import sqlite3
 import time
-from steam.sqlite import Database
-random.seed(10)
-
-
-def copy_table(db, db_mini, fetch_sql, insert_sql, ids=None, keys=None):
-    if ids:
-        data = db.execute(fetch_sql, ids).fetchall()
-    else:
-        data = db.execute(fetch_sql).fetchall()
-    for row in data:
-        row_dict = dict(row)
-        if keys:
-            new_row_dict = {}
-            for k in keys:
-                new_row_dict[k] = row_dict[k]
-            row_dict = new_row_dict
-        columns = ', '.join(row_dict.keys())
-        placeholders = ', '.join('?' * len(row_dict))
-
-        insert_sql = insert_sql.format(columns, placeholders)
-        db_mini.execute(insert_sql, list(row_dict.values()))
-    db_mini.commit()
+from steam.sqlite import TRIGGER_TABLES, Database
+
+ROOT_TABLE = 'product'
+# multiplier of the deterministic shuffle used for sampling (Knuth's multiplicative hash)
+SHUFFLE_MULTIPLIER = 2654435761
+
+
+def table_columns(db, schema, table):
+    return [c[1] for c in db.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def foreign_keys(db):
+    """
+    Returns {table: [(column, referenced table, referenced column)]} as declared in steam/sqlite.py.
+
+    Tables filled by triggers are left out, their rows are created as the other tables are copied.
+    """
+    query = """
+    SELECT name 
+    FROM main.sqlite_master 
+    WHERE type='table' AND name NOT LIKE 'sqlite_%' AND sql NOT LIKE 'CREATE VIRTUAL%'
+    """
+    tables = [name for name, in db.execute(query) if name not in TRIGGER_TABLES]
+    return {table: [(fk[3], fk[2], fk[4] or 'id') for fk in db.execute(f"PRAGMA main.foreign_key_list({table})")]
+            for table in tables}
+
+
+def copy_plan(fks):
+    """
+    Orders tables for copying and returns [(table, clause selecting rows of src.<table> aliased as t)].
+
+    Tables that reference the root table (directly or through other such tables) are copied first, parents before
+    children, keeping rows whose references are all copied. Tables they reference (users, vocabularies) follow,
+    keeping only referenced rows. Tables unrelated to the root table are copied whole.
+    """
+    dependent_tables = {ROOT_TABLE}
+    while True:
+        new = {t for t in fks if t not in dependent_tables and any(p in dependent_tables for _, p, _ in fks[t])}
+        if not new:
+            break
+        dependent_tables |= new
+
+    dependent = [ROOT_TABLE]
+    while len(dependent) < len(dependent_tables):
+        ready = [t for t in fks if t in dependent_tables and t not in dependent and
+                 all(p in dependent or p not in dependent_tables or p == t for _, p, _ in fks[t])]
+        if not ready:
+            raise ValueError('Foreign keys of tables referencing product form a cycle.')
+        dependent += ready
+
+    plan = [(ROOT_TABLE, 'JOIN temp.sample s ON s.id = t.id')]
+    for table in dependent[1:]:
+        conditions = [f't.{column} IN (SELECT {ref_column} FROM main.{parent})'
+                      for column, parent, ref_column in fks[table] if parent in dependent]
+        plan.append((table, 'WHERE ' + ' AND '.join(conditions)))
+
+    # referenced tables, after all of the tables that reference them
+    copied = list(dependent)
+    remaining = [t for t in fks if t not in copied]
+    while remaining:
+        referenced = [t for t in remaining
+                      if any(parent == t for c in copied for _, parent, _ in fks[c]) and
+                      not any(parent == t for c in remaining for _, parent, _ in fks[c])]
+        if not referenced:
+            break
+        for table in referenced:
+            conditions = [f't.{ref_column} IN (SELECT {column} FROM main.{child})'
+                          for child in copied for column, parent, ref_column in fks[child] if parent == table]
+            plan.append((table, 'WHERE ' + ' OR '.join(conditions)))
+            copied.append(table)
+            remaining.remove(table)
+    plan += [(table, '') for table in remaining]
+    return plan
+
+
+def select_products(sqlite_path, where, size, seed):
+    """ Streams ids of products matching where, in a deterministic pseudo-random order, limited to size. """
+    query = f"SELECT id FROM product WHERE {where or '1'} ORDER BY (id * ? + ?) % 4294967296"
+    params = [SHUFFLE_MULTIPLIER, seed]
+    if size:
+        query += " LIMIT ?"
+        params.append(size)
+    src = sqlite3.connect(f'file:{sqlite_path}?mode=ro', uri=True)
+    try:
+        yield from src.execute(query, params)
+    finally:
+        src.close()
+
+
+def copy_table(db, table, clause):
+    """ Copies selected rows of src.table into the minimized database with a single INSERT ... SELECT. """
+    src_columns = table_columns(db, 'src', table)
+    columns = [c for c in table_columns(db, 'main', table) if c in src_columns]
+    if not columns:
+        return 0
+    column_list = ', '.join(columns)
+    select_list = ', '.join(f't.{c}' for c in columns)
+    query = f"INSERT INTO main.{table} ({column_list}) SELECT {select_list} FROM src.{table} t {clause}"
+    return db.execute(query).rowcount
 
 
 def main():
@@ -32,92 +109,34 @@ def main():
     parser.add_argument("--minimized_sqlite_path", default='output/db_mini.psql', type=str,
                         help="Path to database file.")
     parser.add_argument("--size", default=10000, type=int,
-                        help="Number of products to be used (overall about 120k).")
+                        help="Number of products to be used (overall about 120k), 0 for all matching products.")
+    parser.add_argument("--where", default=None, type=str,
+                        help="SQL predicate on product selecting the subset, e.g. \"release_date >= '2020'\".")
+    parser.add_argument("--seed", default=10, type=int,
+                        help="Seed of the product sample.")
     args = parser.parse_args()
-    db_mini = Database(args.minimized_sqlite_path, True)
-    db = Database(args.sqlite_path, False, True)
-    products = [p_id[0] for p_id in db.execute(
-        "SELECT id FROM product;",
-        ()).fetchall()]
-    selected_products = random.sample(products, args.size)
-    product_placeholders = ', '.join('?' * len(selected_products))
-
-    # copy product table
-    fetch_sql = f'SELECT * FROM product WHERE id IN ({product_placeholders});'
-    insert_sql = 'INSERT INTO product ({}) VALUES ({})'
-    copy_table(db, db_mini, fetch_sql, insert_sql, selected_products)
-
-    # copy news
-    fetch_sql = f'SELECT * FROM news WHERE product_id IN ({product_placeholders});'
-    insert_sql = 'INSERT INTO news ({}) VALUES ({})'
-    copy_table(db, db_mini, fetch_sql, insert_sql, selected_products)
-
-    # copy news_ntag
-    fetch_sql = f'SELECT * FROM news_ntag LEFT JOIN news ON news.id == news_id WHERE news.product_id IN ({product_placeholders});'
-    insert_sql = 'INSERT INTO news_ntag ({}) VALUES ({})'
-    keys = dict(db.execute(f'SELECT * FROM news_ntag LIMIT 1;').fetchone()).keys()
-    copy_table(db, db_mini, fetch_sql, insert_sql, selected_products, keys=keys)
-
-    # copy ntag (COMPLETE)
-    fetch_sql = f'SELECT * FROM ntag;'
-    insert_sql = 'INSERT INTO ntag ({}) VALUES ({})'
-    copy_table(db, db_mini, fetch_sql, insert_sql)
-
-    # copy genre (COMPLETE)
-    fetch_sql = f'SELECT * FROM genre;'
-    insert_sql = 'INSERT INTO genre ({}) VALUES ({})'
-    copy_table(db, db_mini, fetch_sql, insert_sql)
-
-    # copy spec (COMPLETE)
-    fetch_sql = f'SELECT * FROM spec;'
-    insert_sql = 'INSERT INTO spec ({}) VALUES ({})'
-    copy_table(db, db_mini, fetch_sql, insert_sql)
-
-    # copy tag (COMPLETE)
-    fetch_sql = f'SELECT * FROM tag;'
-    insert_sql = 'INSERT INTO tag ({}) VALUES ({})'
-    copy_table(db, db_mini, fetch_sql, insert_sql)
-
-    # copy product_genre
-    fetch_sql = f'SELECT * FROM product_genre WHERE product_id IN ({product_placeholders});'
-    insert_sql = 'INSERT INTO product_genre ({}) VALUES ({})'
-    copy_table(db, db_mini, fetch_sql, insert_sql, selected_products)
-
-    # copy product_spec
-    fetch_sql = f'SELECT * FROM product_spec WHERE product_id IN ({product_placeholders});'
-    insert_sql = 'INSERT INTO product_spec ({}) VALUES ({})'
-    copy_table(db, db_mini, fetch_sql, insert_sql, selected_products)
-
-    # copy product_tag
-    fetch_sql = f'SELECT * FROM product_tag WHERE product_id IN ({product_placeholders});'
-    insert_sql = 'INSERT INTO product_tag ({}) VALUES ({})'
-    copy_table(db, db_mini, fetch_sql, insert_sql, selected_products)
-
-    # copy review
-    fetch_sql = f'SELECT * FROM review WHERE product_id IN ({product_placeholders});'
-    insert_sql = 'INSERT INTO review ({}) VALUES ({})'
-    copy_table(db, db_mini, fetch_sql, insert_sql, selected_products)
-
-    # copy rscrape
-    fetch_sql = f'SELECT * FROM rscrape WHERE product_id IN ({product_placeholders});'
-    insert_sql = 'INSERT INTO rscrape ({}) VALUES ({})'
-    copy_table(db, db_mini, fetch_sql, insert_sql, selected_products)
-
-    # copy rscrape_review
-    fetch_sql = f'SELECT * FROM rscrape_review LEFT JOIN rscrape ON rscrape.id == rscrape_id WHERE rscrape.product_id IN ({product_placeholders});'
-    insert_sql = 'INSERT INTO rscrape_review ({}) VALUES ({})'
-    keys = dict(db.execute(f'SELECT * FROM rscrape_review LIMIT 1;').fetchone()).keys()
-    copy_table(db, db_mini, fetch_sql, insert_sql, selected_products, keys=keys)
-
-    # copy user
-    fetch_sql = f'SELECT * FROM user LEFT JOIN review ON review.user_id == user.id WHERE review.product_id IN ({product_placeholders});'
-    insert_sql = 'INSERT OR IGNORE INTO user ({}) VALUES ({})'
-    keys = dict(db.execute(f'SELECT * FROM user LIMIT 1;').fetchone()).keys()
-    copy_table(db, db_mini, fetch_sql, insert_sql, selected_products, keys=keys)
+
+    # the minimized database is written in bulk load mode, its indexes are built on close
+    db_mini = Database(args.minimized_sqlite_path, True, bulk_load=True)
+    db_mini.execute("CREATE TEMP TABLE sample (id INTEGER PRIMARY KEY)")
+    db_mini.db.executemany("INSERT INTO temp.sample (id) VALUES (?)",
+                           select_products(args.sqlite_path, args.where, args.size, args.seed))
+    db_mini.execute("ATTACH DATABASE ? AS src", (args.sqlite_path,))
+
+    for table, clause in copy_plan(foreign_keys(db_mini)):
+        start_time = time.time()
+        rows = copy_table(db_mini, table, clause)
+        print(f'{table}: {rows} rows copied in {time.time() - start_time:.2f} seconds')
+
+    db_mini.commit()
+    db_mini.execute("DETACH DATABASE src")
+    start_time = time.time()
+    db_mini.close()
+    print(f'indexes created in {time.time() - start_time:.2f} seconds')
 
 
 if __name__ == "__main__":
     start_time = time.time()
     main()
     print("Total:")
-    print("--- %s seconds ---" % (time.time() - start_time))
\ No newline at end of file
+    print("--- %s seconds ---" % (time.time() - start_time))
@@ -0,0 +1,41 @@
+"""
+Checks or rebuilds table product_review_stats, the per product review summary kept up to date by triggers.
+
+The check compares every row with an aggregate of the whole review table and exits with an error if they differ.
+With --rebuild the table is recomputed from scratch first. Run it while no crawl writes to the database.
+"""
+import argparse
+import sys
+import time
+
+from steam.sqlite import Database
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='ReviewStats',
+                                     description='The script checks or rebuilds the per product review stats.')
+    parser.add_argument("--sqlite_path", default='output/db.sqlite3', type=str,
+                        help="Path to the database.")
+    parser.add_argument("--rebuild", action='store_true',
+                        help="Recompute the stats from the review table before checking them.")
+    args = parser.parse_args()
+
+    db = Database(args.sqlite_path, False)
+    if args.rebuild:
+        start_time = time.time()
+        db.rebuild_review_stats()
+        print(f'review stats rebuilt in {time.time() - start_time:.2f} seconds')
+
+    start_time = time.time()
+    mismatched = db.check_review_stats()
+    n_products = db.execute("SELECT COUNT(*) FROM product_review_stats").fetchone()[0]
+    db.close()
+    print(f'{n_products} products checked in {time.time() - start_time:.2f} seconds, {len(mismatched)} differ')
+    if mismatched:
+        print(f'products that differ: {", ".join(map(str, mismatched[:20]))}{", ..." if len(mismatched) > 20 else ""}')
+        print('recompute them with --rebuild')
+    return 1 if mismatched else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
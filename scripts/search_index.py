@@ -0,0 +1,68 @@
+"""
+Creates, rebuilds or removes the SQLite FTS5 full-text index of review texts, news and product descriptions.
+
+Creating the index fills it from the existing rows, afterwards triggers keep it up to date as the crawls write. With
+--query, the time of a search through the index is compared with a LIKE scan of the same column. Run it while no
+crawl writes to the database.
+"""
+import argparse
+import os
+import time
+
+from steam.compression import COMPRESSED_COLUMNS
+from steam.sqlite import SEARCH_COLUMNS, Database
+
+
+def like_time(db, table, term):
+    """ Seconds and number of rows of a LIKE search for term through the indexed columns of table. """
+    columns = [f'decompress({column})' if (table, column) in COMPRESSED_COLUMNS else column
+               for column in SEARCH_COLUMNS[table]]
+    condition = ' OR '.join(f'{column} LIKE ?' for column in columns)
+    start_time = time.time()
+    n_rows = db.execute(f"SELECT COUNT(*) FROM {table} WHERE {condition}", [f'%{term}%'] * len(columns)).fetchone()[0]
+    return time.time() - start_time, n_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='SearchIndex',
+                                     description='The script maintains the full-text index of the database.')
+    parser.add_argument("--sqlite_path", default='output/db.sqlite3', type=str,
+                        help="Path to the database.")
+    parser.add_argument("--tables", nargs='*', default=list(SEARCH_COLUMNS), choices=list(SEARCH_COLUMNS),
+                        help="Tables to index.")
+    parser.add_argument("--rebuild", action='store_true',
+                        help="Rebuild indexes that already exist from the tables.")
+    parser.add_argument("--drop", action='store_true',
+                        help="Remove the indexes.")
+    parser.add_argument("--query", default=None, type=str,
+                        help="Word to search for after indexing, the search is also timed with LIKE.")
+    args = parser.parse_args()
+
+    db = Database(args.sqlite_path, False)
+    size = os.path.getsize(args.sqlite_path)
+    start_time = time.time()
+    if args.drop:
+        db.drop_search_index(args.tables)
+        db.execute("VACUUM")
+        print(f'indexes removed in {time.time() - start_time:.2f} seconds')
+    else:
+        existing = [table for table in args.tables if table in db.search_tables()]
+        db.create_search_index(args.tables)
+        if args.rebuild and existing:
+            db.rebuild_search_index(existing)
+        print(f'indexes of {", ".join(args.tables)} ready in {time.time() - start_time:.2f} seconds')
+
+    if args.query and not args.drop:
+        for table in args.tables:
+            start_time = time.time()
+            ids = db.search(table, args.query, limit=None)
+            search_seconds = time.time() - start_time
+            like_seconds, like_rows = like_time(db, table, args.query)
+            print(f'{table}: {len(ids)} matches in {search_seconds:.3f} seconds (best: {ids[:10]}), '
+                  f'LIKE scan {like_rows} rows in {like_seconds:.3f} seconds')
+    db.close()
+    print(f'database {size / 2 ** 20:.1f} MiB -> {os.path.getsize(args.sqlite_path) / 2 ** 20:.1f} MiB')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Compression of large text columns with zlib and preset dictionaries.
+
+Compressed values are stored as BLOBs in the same TEXT columns: a two byte dictionary id followed by a raw deflate
+stream. Values that do not get smaller stay plain text, so a column can hold both and readers tell them apart by type.
+Dictionaries are built from samples of the column they are used for and are kept in the database, since every value
+needs the dictionary it was compressed with.
+"""
+import collections
+import struct
+import zlib
+
+# table, column of the compressed columns
+COMPRESSED_COLUMNS = [('review', 'text'), ('news', 'contents'), ('product', 'description_about'),
+                      ('product', 'description_reviews')]
+
+HEADER = struct.Struct('<H')
+# deflate can only reference the last 32 KiB, a larger dictionary is not used
+MAX_DICTIONARY_SIZE = 32768
+LEVEL = 6
+
+
+def train_dictionary(samples, size=MAX_DICTIONARY_SIZE, max_words=3):
+    """
+    Builds a preset dictionary of the words and phrases of up to max_words words that save the most bytes in samples.
+
+    The most valuable phrases are put at the end of the dictionary, where deflate reaches them with the shortest
+    distances.
+    """
+    counts = collections.Counter()
+    for text in samples:
+        words = text.split()
+        for n in range(1, max_words + 1):
+            for i in range(len(words) - n + 1):
+                counts[' '.join(words[i:i + n])] += 1
+
+    phrases = []
+    total = 0
+    for phrase, count in sorted(counts.items(), key=lambda pc: -pc[1] * len(pc[0])):
+        if count < 2 or total >= size:
+            break
+        data = phrase.encode() + b' '
+        if total + len(data) <= size:
+            phrases.append(data)
+            total += len(data)
+    return b''.join(reversed(phrases))
+
+
+class Compressor:
+    """ Compresses values of a column with its newest dictionary and decompresses values of any dictionary. """
+    def __init__(self, level=LEVEL):
+        self.level = level
+        # dictionary id -> dictionary
+        self.dictionaries = {}
+        # 'table.column' -> id of the dictionary new values are compressed with
+        self.active = {}
+        # compressor with the dictionary already loaded, copied for every value
+        self.compressors = {}
+
+    def load(self, rows):
+        """ Loads (id, 'table.column', dictionary) rows, later ids replace earlier ones for new values. """
+        self.dictionaries = {}
+        self.active = {}
+        self.compressors = {}
+        for dictionary_id, column, data in sorted(rows):
+            self.dictionaries[dictionary_id] = data or b''
+            self.active[column] = dictionary_id
+
+    def compress(self, column, value):
+        """ Compressed value if column is compressed and the value gets smaller, otherwise value itself. """
+        if column not in self.active or not isinstance(value, str) or not value:
+            return value
+        dictionary_id = self.active[column]
+        if dictionary_id not in self.compressors:
+            dictionary = self.dictionaries[dictionary_id]
+            self.compressors[dictionary_id] = (zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=dictionary)
+                                               if dictionary else zlib.compressobj(self.level, zlib.DEFLATED, -15))
+        compressor = self.compressors[dictionary_id].copy()
+        data = value.encode()
+        blob = HEADER.pack(dictionary_id) + compressor.compress(data) + compressor.flush()
+        return blob if len(blob) < len(data) else value
+
+    def decompress(self, value):
+        """ Text of a stored value, plain text and NULL are returned unchanged. """
+        if not isinstance(value, bytes):
+            return value
+        dictionary = self.dictionaries[HEADER.unpack_from(value)[0]]
+        decompressor = zlib.decompressobj(-15, zdict=dictionary) if dictionary else zlib.decompressobj(-15)
+        return (decompressor.decompress(value[HEADER.size:]) + decompressor.flush()).decode()
@@ -0,0 +1,252 @@
+"""
+Extractors that build items straight from the lxml tree of a response.
+
+They produce the same fields as the item loaders in the spiders, but find all nodes of interest with a fixed number of
+precompiled XPath queries per page and apply the field processors of steam/items.py directly instead of going through
+ItemLoader.
+"""
+import re
+
+from lxml import etree
+from parsel.csstranslator import HTMLTranslator
+from w3lib.url import canonicalize_url, url_query_cleaner
+
+from .items import ProductItem, StripText, simplify_recommended, standardize_date, str_to_float, str_to_int
+
+APP_ID_RE = re.compile('/app/(.*?)/')
+DETAILS_SPLIT_RE = re.compile(r'<br>|<div class="dev_row">|<\/div>')
+TAG_RE = re.compile('<[^<]+?>')
+CONTROL_CHARS_RE = re.compile('[\r\t\n]')
+NEWLINES_RE = re.compile('[\r\t\n]+')
+N_REVIEWS_RE = re.compile(r'\(([\d,]+)\)')
+
+DETAILS = [
+    ('Title:', 'title'),
+    ('Genre:', 'genres'),
+    ('Developer:', 'developer'),
+    ('Publisher:', 'publisher'),
+    ('Release Date:', 'release_date')
+]
+
+PRODUCT_IDS = ('game_area_description', 'game_area_reviews', 'game_area_metascore')
+PRODUCT_CLASSES = ('details_block', 'apphub_AppName', 'game_area_details_specs_ctn', 'app_tag', 'game_purchase_price',
+                   'discount_original_price', 'discount_final_price', 'game_review_summary', 'responsive_hidden',
+                   'early_access_header')
+# candidates are matched by substring here and by class token in extract_product
+PRODUCT_NODES = etree.XPath('//*[{}]'.format(' or '.join(
+    [f'@id="{id_}"' for id_ in PRODUCT_IDS] + [f'contains(@class, "{cls}")' for cls in PRODUCT_CLASSES])))
+
+REVIEW_CARDS = etree.XPath(HTMLTranslator().css_to_xpath('div .apphub_Card'))
+REVIEW_CLASSES = ('title', 'date_posted', 'apphub_CardTextContent', 'hours', 'received_compensation',
+                  'apphub_CardContentAuthorName', 'apphub_CardContentMoreLink', 'found_helpful',
+                  'review_award_aggregated', 'early_access_review')
+REVIEW_NODES = etree.XPath(HTMLTranslator().css_to_xpath(', '.join(f'.{cls}' for cls in REVIEW_CLASSES)))
+POSTED_RE = re.compile('Posted: (.+)')
+HOURS_RE = re.compile('(.+) hrs')
+PROFILES_RE = re.compile('.*/profiles/(.+)/')
+USER_ID_RE = re.compile('.*/id/(.+)/')
+PRODUCTS_RE = re.compile(r'([\d,]+) product')
+HELPFUL_RE = re.compile(r'([\d,]+).*helpful')
+FUNNY_RE = re.compile(r'([\d,]+).*funny')
+
+strip = StripText()
+strip_price = StripText(chars=' $\n\t\r')
+
+
+def take_first(values):
+    """ Like TakeFirst: the first value that is neither None nor an empty string. """
+    for value in values:
+        if value is not None and value != '':
+            return value
+
+
+def own_text(node):
+    """ Text nodes that are children of node, like XPath text(). """
+    texts = [node.text] if node.text else []
+    texts += [child.tail for child in node if child.tail]
+    return texts
+
+
+def to_html(node):
+    """ Serializes node the way Selector.get() does. """
+    return etree.tostring(node, method='html', encoding='unicode', with_tail=False)
+
+
+def clean_description(node):
+    """ Description text with tags removed, as load_product's clean_html leaves it after output processing. """
+    text = TAG_RE.sub('', to_html(node))
+    return NEWLINES_RE.sub('\n', text).strip()
+
+
+def extract_product(response):
+    """ Builds the same ProductItem as load_product from a product page response. """
+    nodes = {}
+    for node in PRODUCT_NODES(response.selector.root):
+        for key in PRODUCT_IDS:
+            if node.get('id') == key:
+                nodes.setdefault(key, []).append(node)
+        classes = node.get('class', '').split()
+        for key in PRODUCT_CLASSES:
+            if key in classes:
+                nodes.setdefault(key, []).append(node)
+
+    def first(key):
+        return nodes[key][0] if key in nodes else None
+
+    def first_text(key):
+        return take_first(text for node in nodes.get(key, []) for text in node.itertext())
+
+    item = ProductItem()
+    item['url'] = strip(canonicalize_url(url_query_cleaner(response.url, ['snr'], remove=True)))
+
+    found_id = APP_ID_RE.findall(response.url)
+    if found_id:
+        id_ = found_id[0]
+        item['reviews_url'] = f'http://steamcommunity.com/app/{id_}/reviews/?browsefilter=mostrecent&p=1'
+        item['news_url'] = f'http://store.steampowered.com/news/app/{id_}'
+        if id_:
+            item['id'] = strip(id_)
+
+    # Publication details, the first value of every property wins.
+    details = first('details_block')
+    if details is not None:
+        values = {}
+        for line in DETAILS_SPLIT_RE.split(to_html(details)):
+            line = CONTROL_CHARS_RE.sub('', TAG_RE.sub('', line)).strip()
+            for prop, name in DETAILS:
+                if prop in line:
+                    value = line.replace(prop, '').strip()
+                    if value and name not in values:
+                        values[name] = value
+        for name, value in values.items():
+            if name == 'genres':
+                item[name] = [strip(genre) for genre in value.split(',')]
+            elif name == 'release_date':
+                item[name] = standardize_date(strip(value))
+            else:
+                item[name] = strip(value)
+
+    # load_product falls back to the reviews description when the page has no description.
+    about, reviews = first('game_area_description'), first('game_area_reviews')
+    if about is not None or reviews is not None:
+        item['description_about'] = clean_description(about if about is not None else reviews)
+    if reviews is not None:
+        item['description_reviews'] = clean_description(reviews)
+
+    app_name = first_text('apphub_AppName')
+    if app_name is not None:
+        item['app_name'] = strip(app_name)
+    specs = [text for node in nodes.get('game_area_details_specs_ctn', []) if node.tag == 'a'
+             for text in node.itertext()]
+    if specs:
+        item['specs'] = [strip(spec) for spec in specs]
+    tags = [text for node in nodes.get('app_tag', []) if node.tag == 'a' for text in own_text(node)]
+    if tags:
+        item['tags'] = [strip(tag) for tag in tags]
+
+    price = first_text('game_purchase_price')
+    if not price:
+        price = first_text('discount_original_price')
+        discount_price = first_text('discount_final_price')
+        if discount_price is not None:
+            item['discount_price'] = str_to_float(strip_price(discount_price))
+    if price is not None:
+        item['price'] = str_to_float(strip_price(price))
+
+    sentiment = take_first(text for summary in nodes.get('game_review_summary', [])
+                           for node in summary.getparent().iterchildren(etree.Element)
+                           if node.get('itemprop') == 'description' for text in own_text(node))
+    if sentiment is not None:
+        item['sentiment'] = strip(sentiment)
+
+    n_reviews = [str_to_int(strip(n).replace(',', ''))
+                 for node in nodes.get('responsive_hidden', []) for n in N_REVIEWS_RE.findall(to_html(node))]
+    if n_reviews:
+        item['n_reviews'] = max(n_reviews)
+
+    metascore = take_first(text for node in nodes.get('game_area_metascore', []) if node.tag == 'div'
+                           for score in node.iterchildren('div') if 'score' in score.get('class', '')
+                           for text in own_text(score))
+    if metascore is not None:
+        item['metascore'] = str_to_int(strip(metascore))
+
+    item['early_access'] = 'early_access_header' in nodes
+    return item
+
+
+def extract_reviews(response, product_id, page):
+    """
+    Returns records with the fields of load_review for all review cards of a review page.
+
+    Cards and their fields are found with two XPath queries per page, each field node is assigned to the card it is
+    in. Unlike load_review, a card without a user id gives a record without user_id instead of raising.
+    """
+    cards = REVIEW_CARDS(response.selector.root)
+    card_index = {card: i for i, card in enumerate(cards)}
+    nodes = [{} for _ in cards]
+    for node in REVIEW_NODES(response.selector.root):
+        card = next((card_index[a] for a in node.iterancestors() if a in card_index), None)
+        if card is None:
+            continue
+        classes = node.get('class', '').split()
+        for key in REVIEW_CLASSES:
+            if key in classes:
+                nodes[card].setdefault(key, []).append(node)
+
+    records = []
+    for order, card_nodes in enumerate(nodes):
+        def texts(key, own=True):
+            return [text for node in card_nodes.get(key, []) for text in (own_text(node) if own else node.itertext())]
+
+        def find(regex, values):
+            return take_first(match for value in values for match in regex.findall(value))
+
+        record = {}
+        for name, value in [('product_id', product_id), ('page', page), ('page_order', order)]:
+            if take_first([value]) is not None:
+                record[name] = value
+
+        # Review data.
+        recommended = take_first(texts('title'))
+        if recommended is not None:
+            record['recommended'] = simplify_recommended(recommended)
+        date = find(POSTED_RE, texts('date_posted'))
+        if date is not None:
+            record['date'] = standardize_date(date)
+        text = texts('apphub_CardTextContent')
+        if text:
+            record['text'] = strip('\n'.join(strip(line) for line in text))
+        hours = find(HOURS_RE, texts('hours'))
+        if hours is not None:
+            record['hours'] = str_to_float(hours)
+        compensation = take_first(texts('received_compensation'))
+        if compensation is not None:
+            record['compensation'] = compensation
+
+        # User/reviewer data.
+        authors = [a for node in card_nodes.get('apphub_CardContentAuthorName', []) for a in node.iterdescendants('a')]
+        hrefs = [a.get('href') for a in authors if a.get('href') is not None]
+        user_id = find(PROFILES_RE, hrefs) or find(USER_ID_RE, hrefs)
+        if user_id:
+            record['user_id'] = user_id
+        username = take_first(text for a in authors for text in own_text(a))
+        if username is not None:
+            record['username'] = username
+        products = find(PRODUCTS_RE, texts('apphub_CardContentMoreLink', own=False))
+        if products is not None:
+            record['products'] = str_to_int(products)
+
+        # Review feedback data.
+        feedback = texts('found_helpful', own=False)
+        for name, regex in [('found_helpful', HELPFUL_RE), ('found_funny', FUNNY_RE)]:
+            value = find(regex, feedback)
+            if value is not None:
+                record[name] = str_to_int(value)
+        awarding = take_first(texts('review_award_aggregated', own=False))
+        if awarding is not None:
+            record['found_awarding'] = str_to_int(awarding)
+
+        record['early_access'] = 'early_access_review' in card_nodes
+        record['url'] = response.url
+        records.append(record)
+    return records
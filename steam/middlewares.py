@@ -1,10 +1,20 @@
 import logging
+import math
 import os
+import sqlite3
+import struct
+import time
+import zlib
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
 from w3lib.url import url_query_cleaner
 
-from scrapy.dupefilters import RFPDupeFilter
+from scrapy.dupefilters import BaseDupeFilter, RFPDupeFilter
 from scrapy.extensions.httpcache import FilesystemCacheStorage
-from scrapy.utils.request import fingerprint
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.job import job_dir
+from scrapy.utils.project import data_path
+from scrapy.utils.request import RequestFingerprinter, fingerprint
 
 logger = logging.getLogger(__name__)
 
@@ -23,10 +33,218 @@ class SteamCacheStorage(FilesystemCacheStorage):
         return os.path.join(self.cachedir, spider.name, key[0:2], key)
 
 
+class SteamSQLiteCacheStorage:
+    """
+    HTTP cache storage keeping all responses of a spider in a single SQLite file, <HTTPCACHE_DIR>/<spider>.sqlite3.
+
+    Responses are keyed by the same fingerprint as SteamCacheStorage and stored with zlib compressed bodies. Expired
+    responses are deleted when the spider opens; scripts/compact_httpcache.py reclaims the freed space.
+    """
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.db = None
+        self.stats = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def connect(path):
+        db = sqlite3.connect(path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("""
+        CREATE TABLE IF NOT EXISTS response (
+            fingerprint BLOB PRIMARY KEY, 
+            timestamp REAL NOT NULL, 
+            url TEXT, 
+            status INTEGER, 
+            headers BLOB, 
+            body BLOB)
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS response_timestamp ON response(timestamp)")
+        return db
+
+    @staticmethod
+    def delete_expired(db, expiration_secs):
+        """ Deletes responses older than expiration_secs and returns their number. """
+        if expiration_secs <= 0:
+            return 0
+        deleted = db.execute("DELETE FROM response WHERE timestamp < ?", (time.time() - expiration_secs,)).rowcount
+        db.commit()
+        return deleted
+
+    def open_spider(self, spider):
+        path = os.path.join(self.cachedir, f'{spider.name}.sqlite3')
+        self.db = self.connect(path)
+        self.stats = spider.crawler.stats
+        deleted = self.delete_expired(self.db, self.expiration_secs)
+        logger.debug(f'Using SQLite cache storage in {path}, {deleted} expired responses deleted')
+
+    def close_spider(self, spider):
+        self.db.commit()
+        self.db.close()
+        lookups = self.hits + self.misses
+        if lookups:
+            hit_rate = self.hits / lookups
+            self.stats.set_value('httpcache_sqlite/hit_rate', round(hit_rate, 4), spider=spider)
+            logger.info(f'HTTP cache hit rate {hit_rate:.1%} ({self.hits} of {lookups} requests)')
+
+    @staticmethod
+    def get_fingerprint(request):
+        return fingerprint(strip_snr(request))
+
+    def retrieve_response(self, spider, request):
+        query = "SELECT timestamp, url, status, headers, body FROM response WHERE fingerprint = ?"
+        row = self.db.execute(query, (self.get_fingerprint(request),)).fetchone()
+        if row is None or 0 < self.expiration_secs < time.time() - row[0]:
+            self.misses += 1
+            self.stats.inc_value('httpcache_sqlite/miss' if row is None else 'httpcache_sqlite/expired', spider=spider)
+            return None
+        self.hits += 1
+        self.stats.inc_value('httpcache_sqlite/hit', spider=spider)
+
+        _, url, status, raw_headers, body = row
+        headers = Headers(headers_raw_to_dict(raw_headers))
+        body = zlib.decompress(body)
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        body = zlib.compress(response.body)
+        query = """
+        INSERT OR REPLACE INTO response (fingerprint, timestamp, url, status, headers, body) 
+        VALUES (?, ?, ?, ?, ?, ?)
+        """
+        self.db.execute(query, (self.get_fingerprint(request), time.time(), response.url, response.status,
+                                headers_dict_to_raw(response.headers), body))
+        self.db.commit()
+        self.stats.inc_value('httpcache_sqlite/store', spider=spider)
+        self.stats.inc_value('httpcache_sqlite/body_bytes', len(response.body), spider=spider)
+        self.stats.inc_value('httpcache_sqlite/stored_bytes', len(body), spider=spider)
+
+
+class SteamRequestFingerprinter(RequestFingerprinter):
+    """ Request fingerprinter ignoring the snr query parameter, used by the dupefilters and the scheduler. """
+    def fingerprint(self, request):
+        if 'snr=' in request.url:
+            request = strip_snr(request)
+        return super().fingerprint(request)
+
+
 class SteamDupeFilter(RFPDupeFilter):
-    def request_fingerprint(self, request):
-        request = strip_snr(request)
-        return super().request_fingerprint(request)
+    """ Request dupefilter comparing requests by the crawler's fingerprinter, see REQUEST_FINGERPRINTER_CLASS. """
+
+
+class SteamBloomDupeFilter(BaseDupeFilter):
+    """
+    Request dupefilter keeping fingerprints in a Bloom filter sized for DUPEFILTER_BLOOM_CAPACITY requests with a false
+    positive rate of DUPEFILTER_BLOOM_ERROR_RATE, so its memory use does not grow with the number of requests.
+
+    With JOBDIR, new fingerprints are appended to requests.seen like RFPDupeFilter does, and the filter is saved to
+    requests.bloom on close, together with the length of requests.seen it covers. On resume the saved filter is loaded
+    and only the rest of requests.seen is replayed; a requests.seen without a saved filter is replayed whole.
+    """
+    header = struct.Struct('<QQQQ')
+
+    def __init__(self, path=None, debug=False, capacity=10 ** 7, error_rate=1e-6, *, fingerprinter):
+        # the crawler's fingerprinter, so requests are compared exactly like in the scheduler and the HTTP cache
+        self.fingerprinter = fingerprinter
+        self.debug = debug
+        self.logdupes = True
+        self.capacity = capacity
+        self.n_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.count = 0
+        self.file = None
+        self.bloom_path = None
+        if path:
+            self.bloom_path = os.path.join(path, 'requests.bloom')
+            self.file = open(os.path.join(path, 'requests.seen'), 'a+b')
+            self.load()
+
+    @classmethod
+    def from_settings(cls, settings, *, fingerprinter):
+        return cls(job_dir(settings), settings.getbool('DUPEFILTER_DEBUG'),
+                   settings.getint('DUPEFILTER_BLOOM_CAPACITY'), settings.getfloat('DUPEFILTER_BLOOM_ERROR_RATE'),
+                   fingerprinter=fingerprinter)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls.from_settings(crawler.settings, fingerprinter=crawler.request_fingerprinter)
+
+    def load(self):
+        """ Loads the saved filter and replays fingerprints appended to requests.seen after it was saved. """
+        start_time = time.time()
+        offset = 0
+        if os.path.exists(self.bloom_path):
+            with open(self.bloom_path, 'rb') as f:
+                n_bits, n_hashes, count, seen_offset = self.header.unpack(f.read(self.header.size))
+                if (n_bits, n_hashes) == (self.n_bits, self.n_hashes):
+                    f.readinto(self.bits)
+                    self.count, offset = count, seen_offset
+                else:
+                    logger.info('Bloom filter settings changed, rebuilding it from requests.seen')
+        self.file.seek(offset)
+        replayed = 0
+        for line in self.file:
+            self.add(bytes.fromhex(line.decode().rstrip()))
+            replayed += 1
+        logger.info(f'Loaded {self.count} request fingerprints ({replayed} from requests.seen) '
+                    f'in {time.time() - start_time:.2f} seconds')
+
+    def save(self):
+        self.file.flush()
+        tmp_path = self.bloom_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.header.pack(self.n_bits, self.n_hashes, self.count, self.file.tell()))
+            f.write(self.bits)
+        os.replace(tmp_path, self.bloom_path)
+
+    def add(self, fp):
+        """ Adds fingerprint fp and returns whether it was (probably) added before. """
+        h1 = int.from_bytes(fp[:8], 'little')
+        h2 = int.from_bytes(fp[8:16], 'little') | 1
+        seen = True
+        for i in range(self.n_hashes):
+            bit = (h1 + i * h2) % self.n_bits
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not self.bits[byte] & mask:
+                self.bits[byte] |= mask
+                seen = False
+        if not seen:
+            self.count += 1
+        return seen
+
+    def request_seen(self, request):
+        fp = self.fingerprinter.fingerprint(request)
+        if self.add(fp):
+            return True
+        if self.file:
+            self.file.write(fp.hex().encode() + b'\n')
+        return False
+
+    def false_positive_rate(self):
+        """ Estimated probability that a new request is taken for a duplicate. """
+        return (1 - math.exp(-self.n_hashes * self.count / self.n_bits)) ** self.n_hashes
+
+    def close(self, reason):
+        if self.count > self.capacity:
+            logger.warning(f'Bloom dupefilter holds {self.count} requests, more than its capacity of {self.capacity}; '
+                           f'estimated false positive rate is {self.false_positive_rate():.2g}')
+        if self.file:
+            self.save()
+            self.file.close()
+
+    def log(self, request, spider):
+        if self.debug:
+            logger.debug(f'Filtered duplicate request: {request}', extra={'spider': spider})
+        elif self.logdupes:
+            logger.debug(f'Filtered duplicate request: {request} - no more duplicates will be shown '
+                         f'(see DUPEFILTER_DEBUG to show all duplicates)', extra={'spider': spider})
+            self.logdupes = False
+        spider.crawler.stats.inc_value('dupefilter/filtered', spider=spider)
 
 
 class AddAgeCheckCookieMiddleware(object):
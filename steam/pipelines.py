@@ -7,14 +7,58 @@
 
 import datetime as dt
 
+from twisted.internet.defer import Deferred
+
+from .writer import DatabaseWriter
+
 
 class SQLitePipeline:
+    def __init__(self, flush_size=1, flush_interval=0, writer_enabled=False, writer_queue_size=1000, stats=None):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.writer_enabled = writer_enabled
+        self.writer_queue_size = writer_queue_size
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            flush_size=crawler.settings.getint('SQLITE_FLUSH_SIZE'),
+            flush_interval=crawler.settings.getfloat('SQLITE_FLUSH_INTERVAL'),
+            writer_enabled=crawler.settings.getbool('SQLITE_WRITER_ENABLED'),
+            writer_queue_size=crawler.settings.getint('SQLITE_WRITER_QUEUE_SIZE'),
+            stats=crawler.stats
+        )
+
+    def open_spider(self, spider):
+        if self.writer_enabled:
+            # spider.db is kept for reads, all writes go through the writer's own connection
+            spider.db.writer = DatabaseWriter(spider.db.path, self.writer_queue_size, self.stats,
+                                              flush_size=self.flush_size, flush_interval=self.flush_interval,
+                                              bulk_load=spider.db.loading)
+            # bulk load is finished by the writer's connection
+            spider.db.loading = False
+            spider.db.writer.start()
+        else:
+            spider.db.flush_size = self.flush_size
+            spider.db.flush_interval = self.flush_interval
+
+    @staticmethod
+    def close_spider(spider):
+        if spider.db.writer:
+            writer, spider.db.writer = spider.db.writer, None
+            return writer.stop()
+        spider.db.commit()
+
     @staticmethod
     def process_item(item, spider):
+        result = None
         if spider.name == 'products':
-            spider.db.add_product(item)
+            result = spider.db.submit('refresh_product' if spider.refresh else 'add_product', item)
 
         if spider.name == 'reviews':
-            spider.db.add_review(item, str(dt.datetime.today()), spider.review_ids, spider.rscrape_ids, spider.user_ids)
+            result = spider.db.submit('add_review', item, str(dt.datetime.today()))
 
+        if isinstance(result, Deferred):
+            return result.addCallback(lambda _: item)
         return item
@@ -17,16 +17,36 @@ ITEM_PIPELINES = {
    'steam.pipelines.SQLitePipeline': 300,
 }
 
+# Items are buffered and written in one transaction every SQLITE_FLUSH_SIZE items or
+# SQLITE_FLUSH_INTERVAL seconds, whichever comes first. The settings are independent: an interval of 0 turns the
+# time-based flush off, so only the item count applies (the defaults commit after every product/review page).
+SQLITE_FLUSH_SIZE = 1
+SQLITE_FLUSH_INTERVAL = 0
+
+# Run all SQLite writes on a dedicated thread, so commits and lock waits do not block the reactor.
+SQLITE_WRITER_ENABLED = False
+SQLITE_WRITER_QUEUE_SIZE = 1000
+
+# Product pages are parsed by load_product ('loader') or by the single-pass extractor in steam/extractors.py ('lxml').
+PRODUCT_EXTRACTOR = 'loader'
+# Review cards are parsed by load_review ('loader') or all at once by extract_reviews in steam/extractors.py ('lxml').
+REVIEW_EXTRACTOR = 'loader'
+
 AUTOTHROTTLE_ENABLED = True
 AUTOTHROTTLE_TARGET_CONCURRENCY = 8
 
+REQUEST_FINGERPRINTER_CLASS = 'steam.middlewares.SteamRequestFingerprinter'
+
+# 'steam.middlewares.SteamBloomDupeFilter' keeps fingerprints in a Bloom filter of fixed size instead of a set.
 DUPEFILTER_CLASS = 'steam.middlewares.SteamDupeFilter'
+DUPEFILTER_BLOOM_CAPACITY = 10000000
+DUPEFILTER_BLOOM_ERROR_RATE = 1e-6
 
 HTTPCACHE_ENABLED = True
 HTTPCACHE_EXPIRATION_SECS = 0  # Never expire.
 HTTPCACHE_DIR = 'httpcache'
 HTTPCACHE_IGNORE_HTTP_CODES = [301, 302, 303, 306, 307, 308]
-HTTPCACHE_STORAGE = 'steam.middlewares.SteamCacheStorage'
+HTTPCACHE_STORAGE = 'steam.middlewares.SteamCacheStorage'  # or 'steam.middlewares.SteamSQLiteCacheStorage', one file per spider
 
 AWS_ACCESS_KEY_ID = getenv('AWS_ACCESS_KEY_ID', type=str, default=None)
 AWS_SECRET_ACCESS_KEY = getenv('AWS_SECRET_ACCESS_KEY', type=str, default=None)
@@ -1,5 +1,8 @@
+import contextlib
+import itertools
 import logging
 import re
+import sys
 from scrapy.http import Request
 
 from w3lib.url import canonicalize_url, url_query_cleaner
@@ -8,12 +11,20 @@ from scrapy.http import FormRequest
 from scrapy.linkextractors import LinkExtractor
 from scrapy.spiders import CrawlSpider, Rule
 
+from ..extractors import APP_ID_RE, extract_product
 from ..items import ProductItem, ProductItemLoader
 from ..sqlite import Database
 
 logger = logging.getLogger(__name__)
 
 
+def read_rows(path):
+    """ Yields the rows of an app id file (- for stdin), values separated by commas or whitespace. """
+    with open(path) if path != '-' else contextlib.nullcontext(sys.stdin) as f:
+        for line in f:
+            yield line.replace(',', ' ').split()
+
+
 def load_product(response):
     """Load a ProductItem from the product page response."""
     loader = ProductItemLoader(item=ProductItem(), response=response)
@@ -116,19 +127,90 @@ class ProductSpider(CrawlSpider):
              restrict_css='.search_pagination_right'))
     ]
 
-    def __init__(self, steam_id=None, sqlite_path=None, overwrite_db=False, *args, **kwargs):
+    def __init__(self, steam_id=None, sqlite_path=None, overwrite_db=False, bulk_load=False, app_ids=None,
+                 app_ids_query=None, listing=None, chunk_size=1000, refresh=False, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.db = Database(sqlite_path, overwrite_db == 'True')
+        self.db = Database(sqlite_path, overwrite_db == 'True', bulk_load=bulk_load == 'True')
         self.steam_id = steam_id
         self.processed_products = self.db.get_product_ids()
+        # app ids are read from a file (- for stdin) or a query on the database, one id per line or row,
+        # optionally followed by the request priority
+        self.app_ids = app_ids
+        self.app_ids_query = app_ids_query
+        self.chunk_size = int(chunk_size)
+        # refresh mode fetches pages of stored products again, all of them unless app ids are given
+        self.refresh = refresh == 'True'
+        # the search listing is only crawled without app ids or in refresh mode, unless asked for
+        if listing is None:
+            self.listing = not (app_ids or app_ids_query or self.refresh)
+        else:
+            self.listing = listing == 'True'
 
     def start_requests(self):
         if self.steam_id:
             yield Request(f'http://store.steampowered.com/app/{self.steam_id}/',
                           callback=self.parse_product)
-        else:
+            return
+        if self.app_ids or self.app_ids_query or self.refresh:
+            yield from self.app_requests()
+        if self.listing:
             yield from super().start_requests()
 
+    def read_app_ids(self):
+        """
+        Yields (app id, priority) from app_ids or app_ids_query, or all stored products in refresh mode, reading
+        chunk_size rows at a time. Blank lines and comments are skipped, other rows without a numeric app id are
+        skipped with a warning.
+        """
+        if not self.app_ids and not self.app_ids_query:
+            rows = self.db.iterate("SELECT id FROM product WHERE id > :after ORDER BY id LIMIT :limit", {},
+                                   self.chunk_size)
+        elif self.app_ids_query:
+            # the result is copied to a temporary table and read from it page by page, so that no read of the
+            # database is open while the pipeline writes
+            self.db.execute("DROP TABLE IF EXISTS temp.app_ids")
+            self.db.execute(f"CREATE TEMP TABLE app_ids AS {self.app_ids_query}")
+            rows = (row[1:] for row in self.db.iterate(
+                "SELECT rowid, * FROM temp.app_ids WHERE rowid > :after ORDER BY rowid LIMIT :limit", {},
+                self.chunk_size))
+        else:
+            rows = read_rows(self.app_ids)
+        skipped = 0
+        for number, row in enumerate(rows, 1):
+            if not row or row[0] is None or str(row[0]).startswith('#'):
+                continue
+            try:
+                app_id, priority = int(row[0]), int(row[1]) if len(row) > 1 and row[1] is not None else 0
+            except ValueError:
+                skipped += 1
+                logger.warning(f'Row {number} of app ids skipped, no numeric app id and priority: {list(row)}')
+                continue
+            yield app_id, priority
+        if skipped:
+            logger.warning(f'{skipped} rows of app ids skipped')
+
+    def app_requests(self):
+        """
+        Schedules product pages of app ids that are not in database yet, or of all app ids in refresh mode,
+        chunk_size ids at a time.
+        """
+        app_ids = self.read_app_ids()
+        scheduled = 0
+        seen = set() if self.refresh else self.processed_products
+        # refreshed pages must not come from the HTTP cache or be dropped as seen by the duplicate filter
+        meta, dont_filter = ({'dont_cache': True}, True) if self.refresh else ({}, False)
+        for chunk in iter(lambda: list(itertools.islice(app_ids, self.chunk_size)), []):
+            for app_id, priority in chunk:
+                if app_id in seen:
+                    continue
+                seen.add(app_id)
+                # listing links to this product are skipped from now on
+                self.processed_products.add(app_id)
+                scheduled += 1
+                yield Request(f'http://store.steampowered.com/app/{app_id}/', callback=self.parse_product,
+                              priority=priority, meta=meta, dont_filter=dont_filter)
+            logger.info(f'{scheduled} product pages scheduled from app ids')
+
     @staticmethod
     def get_product_id(response):
         product_id = response.meta.get('product_id', None)
@@ -145,13 +227,15 @@ class ProductSpider(CrawlSpider):
         else:
             return product_id
 
-    @staticmethod
-    def parse_product(response):
-        yield load_product(response)
+    def parse_product(self, response):
+        if self.settings.get('PRODUCT_EXTRACTOR') == 'lxml':
+            yield extract_product(response)
+        else:
+            yield load_product(response)
 
     def process_app_links(self, links):
         for link in links:
-            app_id = re.findall('/app/(.*?)/', link.url)
+            app_id = APP_ID_RE.findall(link.url)
             if len(app_id) == 1 and int(app_id[0]) in self.processed_products:
                 continue
             yield link
@@ -1,11 +1,15 @@
+import datetime as dt
 import re
 import urllib.parse
 import scrapy
 from scrapy.http import FormRequest, Request
+from scrapy.utils.log import failure_to_exc_info
+from twisted.internet.defer import Deferred
 from w3lib.url import url_query_parameter
 
+from ..extractors import extract_reviews
 from ..items import ReviewItem, ReviewItemLoader, str_to_int
-from ..sqlite import Database
+from ..sqlite import Database, shard_path
 
 import logging
 
@@ -36,8 +40,7 @@ def load_review(review, product_id, page, order, response):
     loader.add_value('user_id', user_id[0])
     loader.add_css('username', '.apphub_CardContentAuthorName a::text')
     if not user_id or not text:
-        with open(f'review_fails/{product_id}-p{page}.html', 'w') as wf:
-            wf.write(response.text)
+        save_failed_page(response, product_id, page)
     loader.add_css('products', '.apphub_CardContentMoreLink ::text', re='([\d,]+) product')
 
     # Review feedback data.
@@ -58,6 +61,11 @@ def load_review(review, product_id, page, order, response):
     return loader.load_item()
 
 
+def save_failed_page(response, product_id, page):
+    with open(f'review_fails/{product_id}-p{page}.html', 'w') as wf:
+        wf.write(response.text)
+
+
 def get_page(response):
     from_page = response.meta.get('from_page', None)
 
@@ -71,6 +79,13 @@ def get_page(response):
     return page
 
 
+def refresh_cutoff(refresh_before):
+    """ The reviews_scraped cutoff of refresh mode, refresh_before is a date or a number of days before today. """
+    if refresh_before.isdigit():
+        return str(dt.datetime.today() - dt.timedelta(days=int(refresh_before)))
+    return refresh_before
+
+
 def get_product_id(response):
     product_id = response.meta.get('product_id', None)
 
@@ -98,25 +113,55 @@ class ReviewSpider(scrapy.Spider):
         }
     }
 
-    def __init__(self, sqlite_path=None, steam_id=None, *args, **kwargs):
+    def __init__(self, sqlite_path=None, steam_id=None, shard_index=None, shard_count=None, refresh_before=None,
+                 *args, **kwargs):
         super().__init__(*args, **kwargs)
         logging.log(logging.INFO, 'Loading database.')
-        self.db = Database(sqlite_path, False)
+        if shard_count:
+            # products with id % shard_count == shard_index are crawled into a database of their own
+            shard_index, shard_count = int(shard_index or 0), int(shard_count)
+            if not 0 <= shard_index < shard_count:
+                raise ValueError(f'shard_index must be between 0 and {shard_count - 1}, got {shard_index}.')
+            self.db = Database(shard_path(sqlite_path, shard_index, shard_count), False)
+            self.db.seed_shard(sqlite_path, shard_index, shard_count)
+            logging.log(logging.INFO, f'Writing shard {shard_index} of {shard_count} to {self.db.path}.')
+        else:
+            self.db = Database(sqlite_path, False)
         self.steam_id = steam_id
         # self.db.delete_partially_processed_reviews()
         self.partially_processed_product_urls = self.db.get_last_urls_from_partially_processed_products()
         self.unprocessed_products = self.db.get_products_with_unprocessed_reviews()
-
-        self.review_ids = self.db.get_review_ids()
-        self.rscrape_ids = self.db.get_rscrape_ids()
-        self.user_ids = self.db.get_user_ids()
+        # refresh mode revisits scraped products and stops at the first review stored before the refresh started
+        self.refresh_products = []
+        self.known_review_id = None
+        if refresh_before:
+            self.refresh_products = self.db.get_products_to_refresh(refresh_cutoff(refresh_before))
+            self.known_review_id = self.db.get_max_review_id()
+            logging.log(logging.INFO, f'Refreshing reviews of {len(self.refresh_products)} products.')
         logging.log(logging.INFO, 'Database loaded.')
 
     def read_urls(self):
         for product_id, url in self.unprocessed_products:
             yield scrapy.Request(url, cookies={"wants_mature_content_apps": product_id}, callback=self.parse)
 
+    def refresh_urls(self):
+        for product_id, url in self.refresh_products:
+            # refreshed pages must not come from the HTTP cache or be dropped as seen by the duplicate filter
+            yield scrapy.Request(url, cookies={"wants_mature_content_apps": product_id}, callback=self.parse,
+                                 meta={'refresh': True, 'dont_cache': True}, dont_filter=True)
+
+    def is_known(self, review):
+        """ Whether review was stored before the refresh started. """
+        if 'user_id' not in review:
+            return False
+        review_id = self.db.get_review_id(int(review['product_id']), review['user_id'])
+        return review_id is not None and review_id <= self.known_review_id
+
     def start_requests(self):
+        if self.known_review_id is not None:
+            yield from self.refresh_urls()
+            return
+
         # first go over partially processed products
         for url in self.partially_processed_product_urls:
             # test if URL is in proper format
@@ -150,24 +195,47 @@ class ReviewSpider(scrapy.Spider):
                 redirected_product_id = re.findall("app/(.+?)/", response.meta['redirect_urls'][-1])[0]
             except:  # noqa E722
                 raise Exception(f'Unable to read redirect url! For the following response meta: {response.meta}')
-            self.db.add_review_scraped(redirected_product_id, redirected=True)
-            self.db.commit()
+            self.write('add_review_scraped', redirected_product_id, redirected=True)
+            self.write('maybe_commit')
             return
 
         # Load all reviews on current page.
-        reviews = response.css('div .apphub_Card')
-        for i, review in enumerate(reviews):
-            load_rev = load_review(review, product_id, page, i, response)
-            yield load_rev
-
-        self.db.commit()
+        if self.settings.get('REVIEW_EXTRACTOR') == 'lxml':
+            reviews = extract_reviews(response, product_id, page)
+            for review in reviews:
+                if 'user_id' not in review or 'text' not in review:
+                    save_failed_page(response, product_id, page)
+        else:
+            reviews = (load_review(review, product_id, page, i, response)
+                       for i, review in enumerate(response.css('div .apphub_Card')))
+
+        # In refresh mode, reviews come newest first, so a stored review means the rest is already in database.
+        refresh = response.meta.get('refresh', False)
+        known = False
+        for review in reviews:
+            if refresh and self.is_known(review):
+                known = True
+                continue
+            yield review
+
+        self.write('maybe_commit')
         # Navigate to next page.
         form = response.xpath('//form[contains(@id, "MoreContentForm")]')
-        if form:
-            yield self.process_pagination_form(form, page, product_id)
+        if form and not known:
+            yield self.process_pagination_form(form, page, product_id, refresh)
         else:
-            self.db.add_review_scraped(product_id)
-            self.db.commit()
+            self.write('add_review_scraped', product_id)
+            self.write('maybe_commit')
+
+    def write(self, method, *args, **kwargs):
+        """ Runs a database write method, failures of writes run on the writer thread are logged. """
+        result = self.db.submit(method, *args, **kwargs)
+        if isinstance(result, Deferred):
+            result.addErrback(self.write_failed, method)
+
+    @staticmethod
+    def write_failed(failure, method):
+        logging.error(f'Database {method} failed!', exc_info=failure_to_exc_info(failure))
 
     def form_request_from_last_url(self, url):
         if '?' not in url:
@@ -187,13 +255,15 @@ class ReviewSpider(scrapy.Spider):
         )
         return form_request
 
-    def process_pagination_form(self, form, page=None, product_id=None):
+    def process_pagination_form(self, form, page=None, product_id=None, refresh=False):
         action = form.xpath('@action').extract_first()
         names = form.xpath('input/@name').extract()
         values = form.xpath('input/@value').extract()
 
         formdata = dict(zip(names, values))
         meta = dict(prev_page=page, product_id=product_id)
+        if refresh:
+            meta.update(refresh=True, dont_cache=True)
 
         return FormRequest(
             url=action,
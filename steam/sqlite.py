@@ -1,11 +1,62 @@
 """
 Tools for handling memory/actual database.
 """
+import collections
+import contextlib
+import hashlib
+import json
 import logging
 import sqlite3
 import os
+import time
 import datetime as dt
 
+from .compression import COMPRESSED_COLUMNS, Compressor
+
+
+class LRUCache(collections.OrderedDict):
+    """ Dict that only keeps maxsize most recently used keys. """
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+# scraped product columns, compared when a product is refreshed
+PRODUCT_FIELDS = ['url', 'news_url', 'reviews_url', 'title', 'developer', 'publisher', 'release_date',
+                  'description_about', 'app_name', 'discount_price', 'price', 'early_access', 'sentiment', 'n_reviews',
+                  'metascore', 'description_reviews']
+# item field and vocabulary table of product links
+PRODUCT_LINKS = [('genres', 'genre'), ('specs', 'spec'), ('tags', 'tag')]
+# tables filled by triggers from the other tables, they are not copied between databases
+TRIGGER_TABLES = ['crawl_progress', 'product_review_stats']
+# table: columns of its optional full-text search index, see Database.create_search_index
+SEARCH_COLUMNS = {'review': ['text'], 'news': ['title', 'contents'], 'product': ['description_about']}
+
+
+def product_hash(item):
+    """ Hash of the scraped fields of a product item, including genres, specs and tags in any order. """
+    content = {field: item.get(field) for field in PRODUCT_FIELDS}
+    content.update({key: sorted(item.get(key) or []) for key, _ in PRODUCT_LINKS})
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def shard_path(sqlite_path, shard_index, shard_count):
+    """ Path of the database written by review crawl shard shard_index of shard_count, next to sqlite_path. """
+    root, ext = os.path.splitext(sqlite_path)
+    return f'{root}.shard{shard_index}of{shard_count}{ext}'
+
 
 class Product:
     def __init__(self):
@@ -47,9 +98,21 @@ class Product:
                     metascore REAL,
                     description_reviews TEXT,
                     reviews_scraped DATETIME DEFAULT NULL,
-                    Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                    Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    content_hash TEXT
                     )
                     """)
+        # hash of the scraped fields, refreshed products are only written when it changes
+        self.add_column('product', 'content_hash', 'TEXT')
+
+        # previous values of the fields that changed when a product was refreshed, as JSON
+        self.execute("""CREATE TABLE IF NOT EXISTS product_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    product_id INTEGER,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    changes TEXT,
+                    FOREIGN KEY(product_id) REFERENCES product(id))
+                    """)
 
         self.init("""CREATE TABLE product_genre (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -78,91 +141,123 @@ class Product:
                     )
                     """)
 
+        if not self.loading:
+            self.create_product_indexes()
+
+    def create_product_indexes(self):
+        """ Creates secondary indexes, also on existing databases. """
+        self.execute("CREATE INDEX IF NOT EXISTS product_reviews_scraped ON product (reviews_scraped, n_reviews)")
+        self.execute("CREATE INDEX IF NOT EXISTS product_genre_product ON product_genre (product_id)")
+        self.execute("CREATE INDEX IF NOT EXISTS product_genre_genre ON product_genre (genre_id)")
+        self.execute("CREATE INDEX IF NOT EXISTS product_spec_product ON product_spec (product_id)")
+        self.execute("CREATE INDEX IF NOT EXISTS product_spec_spec ON product_spec (spec_id)")
+        self.execute("CREATE INDEX IF NOT EXISTS product_tag_product ON product_tag (product_id)")
+        self.execute("CREATE INDEX IF NOT EXISTS product_tag_tag ON product_tag (tag_id)")
+        self.execute("CREATE INDEX IF NOT EXISTS product_history_product ON product_history (product_id, timestamp)")
+
     def add_product(self, item):
-        """ Inserts a match to database. """
+        """ Queues a product insert; it is written on the next flush. """
         product_cursor = self.execute("SELECT * FROM product WHERE id=?", (item['id'],))
         product = product_cursor.fetchone()
 
-        if not product:
+        if not product and ('product', item['id']) not in self.pending_keys:
+            self.pending_keys.add(('product', item['id']))
             # populate all items that are to be inserted
             item_dict = dict(item)
             all_keys = ['id', 'url', 'news_url', 'reviews_url', 'title', 'developer', 'publisher', 'release_date', 'description_about', 'app_name', 'discount_price', 'price', 'early_access', 'sentiment', 'n_reviews', 'metascore', 'description_reviews', 'reviews_scraped']
             for key in all_keys:
                 if key not in item_dict:
                     item_dict[key] = None
+            item_dict['content_hash'] = product_hash(item)
+            for key in ('description_about', 'description_reviews'):
+                item_dict[key] = self.compress(f'product.{key}', item_dict[key])
 
             # insert product
             query = """
-            INSERT INTO product (id, url, news_url, reviews_url, title, developer, publisher, release_date, description_about, app_name, discount_price, price, early_access, sentiment, n_reviews, metascore, description_reviews, reviews_scraped) 
-            VALUES (:id, :url, :news_url, :reviews_url, :title, :developer, :publisher, :release_date, :description_about, :app_name, :discount_price, :price, :early_access, :sentiment, :n_reviews, :metascore, :description_reviews, :reviews_scraped)
+            INSERT INTO product (id, url, news_url, reviews_url, title, developer, publisher, release_date, description_about, app_name, discount_price, price, early_access, sentiment, n_reviews, metascore, description_reviews, reviews_scraped, content_hash) 
+            VALUES (:id, :url, :news_url, :reviews_url, :title, :developer, :publisher, :release_date, :description_about, :app_name, :discount_price, :price, :early_access, :sentiment, :n_reviews, :metascore, :description_reviews, :reviews_scraped, :content_hash)
             """
-            product_cursor = self.execute(query, item_dict)
-            product_id = product_cursor.lastrowid
-
-            # handle genres
-            if 'genres' in item and item['genres']:
-                genres_dict = {g: g_id for g_id, g in self.execute("SELECT * FROM genre", ()).fetchall()}
-                for genre in item['genres']:
-                    # add new genres to database
-                    if genre not in genres_dict:
-                        query = """
-                        INSERT INTO genre (name) 
-                        VALUES (?)
-                        """
-                        genre_cursor = self.execute(query, (genre,))
-                        genre_id = genre_cursor.lastrowid
-                    else:
-                        genre_id = genres_dict[genre]
-                    # link products with genres
-                    query = """
-                    INSERT INTO product_genre (product_id, genre_id) 
-                    VALUES (?, ?)
-                    """
-                    self.execute(query, (product_id, genre_id,))
-
-            # handle specs
-            if 'specs' in item and item['specs']:
-                specs_dict = {g: g_id for g_id, g in self.execute("SELECT * FROM spec", ()).fetchall()}
-                for spec in item['specs']:
-                    # add new specs to database
-                    if spec not in specs_dict:
-                        query = """
-                        INSERT INTO spec (name) 
-                        VALUES (?)
-                        """
-                        spec_cursor = self.execute(query, (spec,))
-                        spec_id = spec_cursor.lastrowid
-                    else:
-                        spec_id = specs_dict[spec]
-                    # link products with specs
-                    query = """
-                    INSERT INTO product_spec (product_id, spec_id) 
+            self.queue(query, item_dict)
+            product_id = item_dict['id']
+
+            # link product with genres, specs and tags
+            for key, table in [('genres', 'genre'), ('specs', 'spec'), ('tags', 'tag')]:
+                if key in item and item[key]:
+                    query = f"""
+                    INSERT INTO product_{table} (product_id, {table}_id) 
                     VALUES (?, ?)
                     """
-                    self.execute(query, (product_id, spec_id,))
-
-            # handle tags
-            if 'tags' in item and item['tags']:
-                tags_dict = {g: g_id for g_id, g in self.execute("SELECT * FROM tag", ()).fetchall()}
-                for tag in item['tags']:
-                    # add new tags to database
-                    if tag not in tags_dict:
-                        query = """
-                        INSERT INTO tag (name) 
-                        VALUES (?)
-                        """
-                        tag_cursor = self.execute(query, (tag,))
-                        tag_id = tag_cursor.lastrowid
-                    else:
-                        tag_id = tags_dict[tag]
-                    # link products with tags
-                    query = """
-                    INSERT INTO product_tag (product_id, tag_id) 
-                    VALUES (?, ?)
-                    """
-                    self.execute(query, (product_id, tag_id,))
+                    for name in item[key]:
+                        self.queue(query, (product_id, self.vocabulary_id(table, name)))
 
-            self.commit()
+            self.pending_items += 1
+        self.maybe_commit()
+
+    def refresh_product(self, item):
+        """
+        Queues an update of a stored product with a refreshed item, new products are added. Nothing is written if the
+        content hash did not change, otherwise changed columns are updated, genre, spec and tag links are diffed and
+        the previous values of the changed fields are added to product_history.
+        """
+        content_hash = product_hash(item)
+        compressed = {column for table, column in COMPRESSED_COLUMNS if table == 'product'}
+        query = f"""
+        SELECT content_hash, {', '.join(f'decompress({f})' if f in compressed else f for f in PRODUCT_FIELDS)} 
+        FROM product 
+        WHERE id=?
+        """
+        stored = self.execute(query, (item['id'],)).fetchone()
+        if not stored:
+            self.add_product(item)
+            return
+        if stored[0] == content_hash or ('product', item['id']) in self.pending_keys:
+            return
+        self.pending_keys.add(('product', item['id']))
+
+        changes = {field: old for field, old in zip(PRODUCT_FIELDS, stored[1:]) if old != item.get(field)}
+        for key, table in PRODUCT_LINKS:
+            query = f"""
+            SELECT product_{table}.id, {table}.id, {table}.name 
+            FROM product_{table} JOIN {table} ON {table}.id == product_{table}.{table}_id 
+            WHERE product_id=?
+            """
+            links = self.execute(query, (item['id'],)).fetchall()
+            old = {name_id for _, name_id, _ in links}
+            new = {self.vocabulary_id(table, name) for name in item.get(key) or []}
+            if old == new:
+                continue
+            changes[key] = sorted(name for _, _, name in links)
+            query = f"""
+            DELETE FROM product_{table} 
+            WHERE id=?
+            """
+            for link_id, name_id, _ in links:
+                if name_id not in new:
+                    self.queue(query, (link_id,))
+            query = f"""
+            INSERT INTO product_{table} (product_id, {table}_id) 
+            VALUES (?, ?)
+            """
+            for name_id in new - old:
+                self.queue(query, (item['id'], name_id))
+
+        # products stored before content hashes only get their hash if nothing changed
+        columns = [field for field in PRODUCT_FIELDS if field in changes]
+        query = f"""
+        UPDATE product 
+        SET {''.join(f'{column}=:{column}, ' for column in columns)}content_hash=:content_hash 
+        WHERE id=:id
+        """
+        self.queue(query, {**{column: self.compress(f'product.{column}', item.get(column)) for column in columns},
+                           'content_hash': content_hash, 'id': item['id']})
+        if changes:
+            query = """
+            INSERT INTO product_history (product_id, changes) 
+            VALUES (?, ?)
+            """
+            self.queue(query, (item['id'], json.dumps(changes, default=str)))
+        self.pending_items += 1
+        self.maybe_commit()
 
     def get_product_ids(self):
         query = """
@@ -171,15 +266,48 @@ class Product:
         """
         return {p_id[0] for p_id in self.execute(query, ()).fetchall()}
 
+    def iter_products(self, product_ids=None, batch_size=1000, as_rows=False):
+        """ Yields products (of product_ids) by id, with descriptions decompressed. """
+        query = f"""
+        SELECT id, url, news_url, reviews_url, title, developer, publisher, release_date, 
+            decompress(description_about) AS description_about, app_name, discount_price, price, early_access, 
+            sentiment, n_reviews, metascore, decompress(description_reviews) AS description_reviews, reviews_scraped, 
+            Timestamp, content_hash 
+        FROM product 
+        WHERE id > :after {'' if product_ids is None else 'AND id IN (SELECT value FROM json_each(:product_ids))'} 
+        ORDER BY id 
+        LIMIT :limit
+        """
+        params = {'product_ids': json.dumps(sorted(product_ids or []))}
+        return self.iterate(query, params, batch_size, as_rows)
+
     def init(self, *args, **kwargs):
         pass
 
     def commit(self, *args, **kwargs):
         pass
 
+    def maybe_commit(self, *args, **kwargs):
+        pass
+
     def execute(self, *args, **kwargs):
         pass
 
+    def queue(self, *args, **kwargs):
+        pass
+
+    def iterate(self, *args, **kwargs):
+        pass
+
+    def vocabulary_id(self, *args, **kwargs):
+        pass
+
+    def add_column(self, *args, **kwargs):
+        pass
+
+    def compress(self, *args, **kwargs):
+        pass
+
 
 class Review:
     def __init__(self):
@@ -228,6 +356,218 @@ class Review:
                     FOREIGN KEY(review_id) REFERENCES review(id))
                     """)
 
+        # natural keys used for deduplication, also added to existing databases
+        merged_pages = self.number_review_pages()
+        try:
+            self.execute("CREATE UNIQUE INDEX IF NOT EXISTS rscrape_product_page ON rscrape (product_id, page)")
+            self.execute("CREATE UNIQUE INDEX IF NOT EXISTS review_product_user ON review (product_id, user_id)")
+        except sqlite3.IntegrityError:
+            logging.log(logging.ERROR, 'Database contains duplicated reviews or review pages, remove them first!')
+            raise
+
+        # crawl state of every product, kept up to date by triggers so that resuming a crawl does not aggregate the
+        # whole review and rscrape tables; existing databases are backfilled once
+        crawl_progress_exists = self.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='crawl_progress'").fetchone()
+        self.execute("""CREATE TABLE IF NOT EXISTS crawl_progress (
+                    product_id INTEGER PRIMARY KEY,
+                    last_url TEXT,
+                    pages INTEGER NOT NULL DEFAULT 0,
+                    reviews INTEGER NOT NULL DEFAULT 0,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    FOREIGN KEY(product_id) REFERENCES product(id))
+                    """)
+        self.create_crawl_progress_triggers()
+        if (merged_pages or not crawl_progress_exists) and not self.new:
+            logging.log(logging.INFO, 'Building crawl progress of existing database.')
+            self.rebuild_crawl_progress()
+
+        # running review counts, sums and date bounds of every product, kept up to date by triggers so that per
+        # product summaries do not aggregate the whole review table; existing databases are backfilled once
+        review_stats_exists = self.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='product_review_stats'").fetchone()
+        self.execute("""CREATE TABLE IF NOT EXISTS product_review_stats (
+                    product_id INTEGER PRIMARY KEY,
+                    reviews INTEGER NOT NULL DEFAULT 0,
+                    recommended INTEGER NOT NULL DEFAULT 0,
+                    early_access INTEGER NOT NULL DEFAULT 0,
+                    hours_reviews INTEGER NOT NULL DEFAULT 0,
+                    hours_sum REAL NOT NULL DEFAULT 0,
+                    found_helpful_sum INTEGER NOT NULL DEFAULT 0,
+                    found_funny_sum INTEGER NOT NULL DEFAULT 0,
+                    first_date TEXT,
+                    last_date TEXT,
+                    FOREIGN KEY(product_id) REFERENCES product(id))
+                    """)
+        self.create_review_stats_triggers()
+        if not review_stats_exists and not self.new:
+            logging.log(logging.INFO, 'Building review stats of existing database.')
+            self.rebuild_review_stats()
+
+        if not self.loading:
+            self.create_review_indexes()
+
+    def create_crawl_progress_triggers(self):
+        """ Triggers that keep crawl_progress in step with product, rscrape and review writes and review deletes. """
+        # state is 'pending' before the first review is stored, 'partial' while reviews are being scraped and 'done'
+        # once product.reviews_scraped is set
+        self.execute("""CREATE TRIGGER IF NOT EXISTS crawl_progress_product_insert 
+                    AFTER INSERT ON product WHEN NOT NEW.n_reviews IS NULL OR NOT NEW.reviews_scraped IS NULL 
+                    BEGIN 
+                        INSERT OR IGNORE INTO crawl_progress (product_id, state) 
+                        VALUES (NEW.id, CASE WHEN NEW.reviews_scraped IS NULL THEN 'pending' ELSE 'done' END);
+                    END
+                    """)
+        self.execute("""CREATE TRIGGER IF NOT EXISTS crawl_progress_product_update 
+                    AFTER UPDATE OF reviews_scraped, n_reviews ON product 
+                    WHEN NOT NEW.n_reviews IS NULL OR NOT NEW.reviews_scraped IS NULL OR NOT OLD.reviews_scraped IS NULL 
+                    BEGIN 
+                        INSERT INTO crawl_progress (product_id) VALUES (NEW.id) ON CONFLICT (product_id) DO NOTHING;
+                        UPDATE crawl_progress 
+                        SET state=CASE 
+                            WHEN NOT NEW.reviews_scraped IS NULL THEN 'done' 
+                            WHEN reviews > 0 THEN 'partial' 
+                            ELSE 'pending' END 
+                        WHERE product_id == NEW.id;
+                    END
+                    """)
+        self.execute("""CREATE TRIGGER IF NOT EXISTS crawl_progress_rscrape_insert 
+                    AFTER INSERT ON rscrape 
+                    BEGIN 
+                        INSERT INTO crawl_progress (product_id, last_url, pages) VALUES (NEW.product_id, NEW.url, 1) 
+                        ON CONFLICT (product_id) DO UPDATE SET last_url=excluded.last_url, pages=pages + 1;
+                    END
+                    """)
+        self.execute("""CREATE TRIGGER IF NOT EXISTS crawl_progress_review_insert 
+                    AFTER INSERT ON review 
+                    BEGIN 
+                        INSERT INTO crawl_progress (product_id, reviews, state) VALUES (NEW.product_id, 1, 'partial') 
+                        ON CONFLICT (product_id) DO UPDATE SET 
+                            reviews=reviews + 1, 
+                            state=CASE WHEN state == 'pending' THEN 'partial' ELSE state END;
+                    END
+                    """)
+        self.execute("""CREATE TRIGGER IF NOT EXISTS crawl_progress_review_delete 
+                    AFTER DELETE ON review 
+                    BEGIN 
+                        UPDATE crawl_progress 
+                        SET reviews=reviews - 1, 
+                            state=CASE WHEN state == 'partial' AND reviews <= 1 THEN 'pending' ELSE state END 
+                        WHERE product_id == OLD.product_id;
+                    END
+                    """)
+
+    def rebuild_crawl_progress(self):
+        """ Recomputes crawl_progress from product, rscrape and review tables. """
+        self.commit()
+        self.execute("DELETE FROM crawl_progress")
+        query = """
+        INSERT INTO crawl_progress (product_id, last_url, pages, reviews, state) 
+        SELECT id, last_url, pages, reviews, 
+            CASE WHEN NOT reviews_scraped IS NULL THEN 'done' WHEN reviews > 0 THEN 'partial' ELSE 'pending' END 
+        FROM (
+            SELECT product.id, n_reviews, reviews_scraped, 
+                (SELECT url FROM rscrape WHERE product_id == product.id ORDER BY timestamp DESC, id DESC LIMIT 1) 
+                    AS last_url, 
+                (SELECT COUNT(*) FROM rscrape WHERE product_id == product.id) AS pages, 
+                (SELECT COUNT(*) FROM review WHERE product_id == product.id) AS reviews 
+            FROM product 
+        ) 
+        WHERE NOT n_reviews IS NULL OR NOT reviews_scraped IS NULL OR NOT last_url IS NULL
+        """
+        self.execute(query)
+        self.commit()
+
+    def create_review_stats_triggers(self):
+        """ Triggers that keep product_review_stats in step with review inserts and deletes. """
+        self.execute("""CREATE TRIGGER IF NOT EXISTS review_stats_review_insert 
+                    AFTER INSERT ON review 
+                    BEGIN 
+                        INSERT INTO product_review_stats (product_id, reviews, recommended, early_access, 
+                            hours_reviews, hours_sum, found_helpful_sum, found_funny_sum, first_date, last_date) 
+                        VALUES (NEW.product_id, 1, CAST(NEW.recommended AS INTEGER) IS 1, 
+                            CAST(NEW.early_access AS INTEGER) IS 1, NEW.hours IS NOT NULL, IFNULL(NEW.hours, 0), 
+                            IFNULL(NEW.found_helpful, 0), IFNULL(NEW.found_funny, 0), NEW.date, NEW.date) 
+                        ON CONFLICT (product_id) DO UPDATE SET 
+                            reviews=reviews + 1, 
+                            recommended=recommended + excluded.recommended, 
+                            early_access=early_access + excluded.early_access, 
+                            hours_reviews=hours_reviews + excluded.hours_reviews, 
+                            hours_sum=hours_sum + excluded.hours_sum, 
+                            found_helpful_sum=found_helpful_sum + excluded.found_helpful_sum, 
+                            found_funny_sum=found_funny_sum + excluded.found_funny_sum, 
+                            first_date=COALESCE(MIN(first_date, excluded.first_date), first_date, excluded.first_date), 
+                            last_date=COALESCE(MAX(last_date, excluded.last_date), last_date, excluded.last_date);
+                    END
+                    """)
+        # date bounds are looked up again only when the deleted review was on one of them
+        self.execute("""CREATE TRIGGER IF NOT EXISTS review_stats_review_delete 
+                    AFTER DELETE ON review 
+                    BEGIN 
+                        UPDATE product_review_stats SET 
+                            reviews=reviews - 1, 
+                            recommended=recommended - (CAST(OLD.recommended AS INTEGER) IS 1), 
+                            early_access=early_access - (CAST(OLD.early_access AS INTEGER) IS 1), 
+                            hours_reviews=hours_reviews - (OLD.hours IS NOT NULL), 
+                            hours_sum=hours_sum - IFNULL(OLD.hours, 0), 
+                            found_helpful_sum=found_helpful_sum - IFNULL(OLD.found_helpful, 0), 
+                            found_funny_sum=found_funny_sum - IFNULL(OLD.found_funny, 0), 
+                            first_date=CASE WHEN OLD.date IS first_date 
+                                THEN (SELECT MIN(date) FROM review WHERE product_id == OLD.product_id) 
+                                ELSE first_date END, 
+                            last_date=CASE WHEN OLD.date IS last_date 
+                                THEN (SELECT MAX(date) FROM review WHERE product_id == OLD.product_id) 
+                                ELSE last_date END 
+                        WHERE product_id == OLD.product_id;
+                        DELETE FROM product_review_stats WHERE product_id == OLD.product_id AND reviews <= 0;
+                    END
+                    """)
+
+    def rebuild_review_stats(self):
+        """ Recomputes product_review_stats from the review table. """
+        self.commit()
+        self.execute("DELETE FROM product_review_stats")
+        query = """
+        INSERT INTO product_review_stats (product_id, reviews, recommended, early_access, hours_reviews, hours_sum, 
+            found_helpful_sum, found_funny_sum, first_date, last_date) 
+        SELECT product_id, COUNT(*), SUM(CAST(recommended AS INTEGER) IS 1), SUM(CAST(early_access AS INTEGER) IS 1), 
+            COUNT(hours), TOTAL(hours), IFNULL(SUM(found_helpful), 0), IFNULL(SUM(found_funny), 0), MIN(date), 
+            MAX(date) 
+        FROM review 
+        GROUP BY product_id
+        """
+        self.execute(query)
+        self.commit()
+
+    def check_review_stats(self):
+        """ Returns ids of products whose product_review_stats row differs from an aggregate of the review table. """
+        self.commit()
+        # sums of hours are compared rounded, they depend on the order reviews were added in
+        query = """
+        WITH expected AS (
+            SELECT product_id, COUNT(*), SUM(CAST(recommended AS INTEGER) IS 1), 
+                SUM(CAST(early_access AS INTEGER) IS 1), COUNT(hours), ROUND(TOTAL(hours), 3), 
+                IFNULL(SUM(found_helpful), 0), IFNULL(SUM(found_funny), 0), MIN(date), MAX(date) 
+            FROM review 
+            GROUP BY product_id
+        ), stored AS (
+            SELECT product_id, reviews, recommended, early_access, hours_reviews, ROUND(hours_sum, 3), 
+                found_helpful_sum, found_funny_sum, first_date, last_date 
+            FROM product_review_stats
+        ) 
+        SELECT product_id FROM (SELECT * FROM expected EXCEPT SELECT * FROM stored) 
+        UNION 
+        SELECT product_id FROM (SELECT * FROM stored EXCEPT SELECT * FROM expected)
+        """
+        return [p_id for p_id, in self.execute(query).fetchall()]
+
+    def create_review_indexes(self):
+        """ Creates secondary indexes, also on existing databases. """
+        self.execute("CREATE INDEX IF NOT EXISTS crawl_progress_state ON crawl_progress (state)")
+        self.execute("CREATE INDEX IF NOT EXISTS review_user ON review (user_id)")
+        self.execute("CREATE INDEX IF NOT EXISTS rscrape_review_rscrape ON rscrape_review (rscrape_id)")
+        self.execute("CREATE INDEX IF NOT EXISTS rscrape_review_review ON rscrape_review (review_id)")
+
     def delete_partially_processed_reviews(self):
         """ Deletes partially scraped reviews. Cleans review, rscrape and rscrape_review tables. """
         query = """
@@ -253,6 +593,16 @@ class Review:
         """
         self.execute(query)
 
+        # stats rows go first, so the delete trigger does not look up date bounds for every review
+        query = """
+        DELETE FROM product_review_stats 
+        WHERE product_id IN (
+            SELECT id FROM product 
+            WHERE (reviews_scraped=='1' OR reviews_scraped IS NULL) AND n_reviews IS NOT NULL
+        )
+        """
+        self.execute(query)
+
         query = """
         DELETE FROM review 
         WHERE product_id IN (
@@ -268,38 +618,63 @@ class Review:
         """
         self.execute(query)
 
+        query = """
+        UPDATE crawl_progress SET last_url=NULL, pages=0, reviews=0, state='pending' 
+        WHERE product_id IN (
+            SELECT id FROM product 
+            WHERE reviews_scraped IS NULL AND n_reviews IS NOT NULL
+        )
+        """
+        self.execute(query)
+
         self.commit()
+        self.rscrape_cache.clear()
 
     def get_last_urls_from_partially_processed_products(self):
         """ Return a list with urls of or unfinished products that have reviews (10+). """
         query = """
-        SELECT url 
-        FROM (
-            SELECT url, MAX(timestamp) AS latest_timestamp 
-            FROM rscrape 
-            WHERE product_id IN (
-                SELECT id 
-                FROM (
-                    SELECT product.id, reviews_url, COUNT(review.id) AS scraped_review_n 
-                    FROM product LEFT JOIN review ON product.id == review.product_id 
-                    WHERE reviews_scraped IS NULL AND NOT n_reviews IS NULL 
-                    GROUP BY product.id 
-                    HAVING scraped_review_n > 0
-                )
-            )
-            GROUP BY rscrape.product_id
-        )
+        SELECT last_url 
+        FROM crawl_progress JOIN product ON product.id == crawl_progress.product_id 
+        WHERE state == 'partial' AND NOT n_reviews IS NULL AND NOT last_url IS NULL
         """
         return [url[0] for url in self.execute(query, ()).fetchall()]
 
     def get_products_with_unprocessed_reviews(self):
         """ Return a list with unprocessed or unfinished products that have reviews (10+). """
         query = """
-        SELECT product.id, reviews_url, COUNT(review.id) AS scraped_review_n 
-        FROM product LEFT JOIN review ON product.id == review.product_id 
-        WHERE reviews_scraped IS NULL AND NOT n_reviews IS NULL GROUP BY product.id HAVING scraped_review_n == 0
+        SELECT product.id, reviews_url 
+        FROM crawl_progress JOIN product ON product.id == crawl_progress.product_id 
+        WHERE state == 'pending' AND NOT n_reviews IS NULL 
+        ORDER BY crawl_progress.product_id
+        """
+        return self.execute(query, ()).fetchall()
+
+    def get_products_to_refresh(self, scraped_before):
+        """ Return a list of products whose reviews were scraped before scraped_before, least recently scraped first. """
+        query = """
+        SELECT id, reviews_url 
+        FROM product 
+        WHERE reviews_scraped < ? AND reviews_scraped != 'REDIRECTED' AND NOT n_reviews IS NULL 
+        ORDER BY reviews_scraped
+        """
+        return self.execute(query, (scraped_before,)).fetchall()
+
+    def get_max_review_id(self):
+        query = """
+        SELECT MAX(id) 
+        FROM review
+        """
+        return self.execute(query).fetchone()[0] or 0
+
+    def get_review_id(self, product_id, user_id):
+        """ Returns id of the review of product_id by user_id, None if it is not stored. """
+        query = """
+        SELECT id 
+        FROM review 
+        WHERE product_id=? AND user_id=?
         """
-        return [(p_id, reviews_url) for p_id, reviews_url, _ in self.execute(query, ()).fetchall()]
+        row = self.execute(query, (product_id, user_id)).fetchone()
+        return row[0] if row else None
 
     def get_review_ids(self):
         query = """
@@ -342,61 +717,121 @@ class Review:
         """
         self.execute(query, (reviews_scraped, product_id))
 
-    def add_review(self, item, date, review_ids, rscrape_ids, user_ids):
-        """ Inserts a match to database. """
+    def number_review_pages(self):
+        """
+        Stores review pages without a page number as page 0, as NULL pages never conflict in the unique index.
+        Unnumbered pages of the same product are merged into the first one, returns the number of pages merged.
+        """
+        if not self.execute("SELECT 1 FROM rscrape WHERE page IS NULL LIMIT 1").fetchone():
+            return 0
+        query = """
+        UPDATE rscrape_review SET rscrape_id=(
+            SELECT MIN(first.id) 
+            FROM rscrape AS page JOIN rscrape AS first ON first.product_id == page.product_id 
+            WHERE page.id == rscrape_review.rscrape_id AND first.page IS NULL
+        ) 
+        WHERE rscrape_id IN (SELECT id FROM rscrape WHERE page IS NULL)
+        """
+        self.execute(query)
+        query = """
+        DELETE FROM rscrape 
+        WHERE page IS NULL AND id != (
+            SELECT MIN(id) FROM rscrape AS first WHERE first.product_id == rscrape.product_id AND first.page IS NULL
+        )
+        """
+        merged = self.execute(query).rowcount
+        self.execute("UPDATE rscrape SET page=0 WHERE page IS NULL")
+        self.commit()
+        return merged
+
+    def get_rscrape_id(self, item_dict):
+        """ Returns id of the scraped review page, inserting it if it is new. Pages without a number are page 0. """
+        if item_dict['page'] is None:
+            item_dict['page'] = 0
+        key = (int(item_dict['product_id']), item_dict['page'])
+        rscrape_id = self.rscrape_cache.get(key)
+        if rscrape_id is None:
+            query = """
+            INSERT INTO rscrape (status, page, url, timestamp, product_id) 
+            VALUES (:status, :page, :url, :timestamp, :product_id)
+            ON CONFLICT (product_id, page) DO UPDATE SET status=excluded.status
+            RETURNING id
+            """
+            rscrape_id = self.execute(query, item_dict).fetchone()[0]
+            self.rscrape_cache[key] = rscrape_id
+        return rscrape_id
+
+    def add_review(self, item, date):
+        """ Queues a review insert; it is written on the next flush. Reviews already in database are ignored. """
         if 'product_id' not in item or 'user_id' not in item:
             return
 
-        if (int(item['product_id']), item['user_id']) not in review_ids:
-            # populate all items that are to be inserted
-            item_dict = dict(item)
-            item_dict['date'] = date
-            item_dict['status'] = 'OK'
-            item_dict['timestamp'] = date
-            all_keys = ['status', 'page', 'timestamp', 'product_id', 'username', 'products', 'recommended', 'date', 'text', 'hours', 'found_awarding', 'early_access', 'found_helpful', 'found_funny', 'compensation']
-            for key in all_keys:
-                if key not in item_dict:
-                    item_dict[key] = None
-
+        # populate all items that are to be inserted
+        item_dict = dict(item)
+        item_dict['date'] = date
+        item_dict['status'] = 'OK'
+        item_dict['timestamp'] = date
+        all_keys = ['status', 'page', 'timestamp', 'product_id', 'username', 'products', 'recommended', 'date', 'text', 'hours', 'found_awarding', 'early_access', 'found_helpful', 'found_funny', 'compensation']
+        for key in all_keys:
+            if key not in item_dict:
+                item_dict[key] = None
+        item_dict['text'] = self.compress('review.text', item_dict['text'])
 
-            if (int(item['product_id']), item['page']) not in rscrape_ids:
-                query = """
-                INSERT INTO rscrape (status, page, url, timestamp, product_id) 
-                VALUES (:status, :page, :url, :timestamp, :product_id)
-                """
-                rscrape_cursor = self.execute(query, item_dict)
-                rscrape_id = rscrape_cursor.lastrowid
-                rscrape_ids[(int(item['product_id']), item['page'])] = rscrape_id
-            else:
-                rscrape_id = rscrape_ids[(int(item['product_id']), item['page'])]
-
-            if item['user_id'] not in user_ids:
-                try:
-                    query = """
-                    INSERT INTO user (id, username, products) 
-                    VALUES (:user_id, :username, :products)
-                    """
-                    self.execute(query, item_dict)
-                except:
-                    logging.log(logging.ERROR, 'Adding user to database failed!')
-                user_ids.add(item['user_id'])
+        item_dict['rscrape_id'] = self.get_rscrape_id(item_dict)
 
-            # insert review
+        if item['user_id'] not in self.user_cache:
             query = """
-            INSERT INTO review (recommended, date, text, hours, found_awarding, early_access, found_helpful, found_funny, compensation, product_id, user_id) 
-            VALUES (:recommended, :date, :text, :hours, :found_awarding, :early_access, :found_helpful, :found_funny, :compensation, :product_id, :user_id)
+            INSERT OR IGNORE INTO user (id, username, products) 
+            VALUES (:user_id, :username, :products)
             """
-            review_cursor = self.execute(query, item_dict)
-            review_id = review_cursor.lastrowid
-            item_dict['review_id'] = review_id
-            item_dict['rscrape_id'] = rscrape_id
-            review_ids[(int(item['product_id']), item['user_id'])] = review_id
+            self.queue(query, item_dict)
+            self.user_cache[item['user_id']] = True
 
-            query = """
-            INSERT INTO rscrape_review (rscrape_id, review_id) 
-            VALUES (:rscrape_id, :review_id)
+        # insert review, ids are assigned up front so that rows can be written later with executemany; reviews that
+        # are already stored are skipped, while an id taken by another connection fails the flush
+        item_dict['review_id'] = self.next_id('review')
+        query = """
+        INSERT INTO review (id, recommended, date, text, hours, found_awarding, early_access, found_helpful, found_funny, compensation, product_id, user_id) 
+        VALUES (:review_id, :recommended, :date, :text, :hours, :found_awarding, :early_access, :found_helpful, :found_funny, :compensation, :product_id, :user_id)
+        ON CONFLICT (product_id, user_id) DO NOTHING
+        """
+        self.queue(query, item_dict)
+
+        # only link reviews that were actually inserted
+        query = """
+        INSERT INTO rscrape_review (rscrape_id, review_id) 
+        SELECT :rscrape_id, id FROM review WHERE id = :review_id
+        """
+        self.queue(query, item_dict)
+        self.pending_items += 1
+
+    def iter_reviews(self, product_ids=None, since=None, batch_size=1000, as_rows=False):
+        """
+        Yields reviews (of product_ids, dated since or later) with text decompressed. All reviews are read by id,
+        reviews of product_ids product by product.
+        """
+        columns = """id, recommended, date, decompress(text) AS text, hours, found_awarding, early_access, 
+            found_helpful, found_funny, compensation, product_id, user_id"""
+        since = None if since is None else str(since)
+        since_condition = '' if since is None else 'AND date >= :since'
+        if product_ids is None:
+            query = f"""
+            SELECT {columns} 
+            FROM review 
+            WHERE id > :after {since_condition} 
+            ORDER BY id 
+            LIMIT :limit
             """
-            self.execute(query, item_dict)
+            yield from self.iterate(query, {'since': since}, batch_size, as_rows)
+            return
+
+        query = f"""
+        SELECT {columns} 
+        FROM review 
+        WHERE product_id = :product_id {since_condition}
+        """
+        for product_id in product_ids:
+            yield from self.iterate(query, {'product_id': product_id, 'since': since}, batch_size, as_rows)
 
     def get_product_ids(self):
         query = """
@@ -411,9 +846,24 @@ class Review:
     def commit(self, *args, **kwargs):
         pass
 
+    def maybe_commit(self, *args, **kwargs):
+        pass
+
     def execute(self, *args, **kwargs):
         pass
 
+    def queue(self, *args, **kwargs):
+        pass
+
+    def iterate(self, *args, **kwargs):
+        pass
+
+    def next_id(self, *args, **kwargs):
+        pass
+
+    def compress(self, *args, **kwargs):
+        pass
+
 
 class News:
     def __init__(self):
@@ -438,8 +888,12 @@ class News:
                     feed_name TEXT,
                     feed_label TEXT,
                     feed_type INTEGER,
+                    gid TEXT,
                     FOREIGN KEY(product_id) REFERENCES product(id))
                     """)
+        # Steam news id, used to upsert refetched news
+        self.add_column('news', 'gid', 'TEXT')
+        self.execute("CREATE UNIQUE INDEX IF NOT EXISTS news_gid ON news (gid)")
 
         self.init("""CREATE TABLE ntag (
                             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -455,54 +909,106 @@ class News:
                             )
                             """)
 
+        if not self.loading:
+            self.create_news_indexes()
+
+    def create_news_indexes(self):
+        """ Creates secondary indexes, also on existing databases. """
+        self.execute("CREATE INDEX IF NOT EXISTS news_product_date ON news (product_id, date)")
+        self.execute("CREATE INDEX IF NOT EXISTS news_ntag_news_ntag ON news_ntag (news_id, ntag_id)")
+        self.execute("CREATE INDEX IF NOT EXISTS news_ntag_ntag ON news_ntag (ntag_id)")
+
     def get_products_without_news(self):
         """ Return a list of product_ids that have reviews but no news. """
         query = """
-        SELECT DISTINCT product.id 
-        FROM product LEFT JOIN news ON product.id == news.product_id 
-        WHERE reviews_scraped IS NOT NULL AND news.id IS NULL;
+        SELECT product.id 
+        FROM product 
+        WHERE reviews_scraped IS NOT NULL AND NOT EXISTS (SELECT 1 FROM news WHERE news.product_id == product.id);
         """
         return [p_id[0] for p_id in self.execute(query, ()).fetchall()]
 
-    def add_news(self, item_dict, tags):
+    def get_latest_news_dates(self):
+        """ Return a list of (product_id, date of newest news or None) for products that have reviews. """
+        query = """
+        SELECT product.id, (SELECT MAX(date) FROM news WHERE news.product_id == product.id) 
+        FROM product 
+        WHERE reviews_scraped IS NOT NULL;
+        """
+        return self.execute(query, ()).fetchall()
+
+    def add_news(self, item_dict):
         """ Inserts a match to database. """
         item_dict['date'] = dt.datetime.utcfromtimestamp(item_dict['date'])
         item_dict['timestamp'] = str(dt.datetime.today())
         item_dict['product_id'] = item_dict['appid']
         item_dict['feed_name'] = item_dict['feedname']
         item_dict['feed_label'] = item_dict['feedlabel']
-        all_keys = ['title', 'author', 'contents', 'date', 'timestamp', 'product_id', 'feed_name', 'feed_label',
+        all_keys = ['gid', 'title', 'author', 'contents', 'date', 'timestamp', 'product_id', 'feed_name', 'feed_label',
                     'feed_type']
 
         for key in all_keys:
             if key not in item_dict:
                 item_dict[key] = None
+        item_dict['contents'] = self.compress('news.contents', item_dict['contents'])
+        # news stored before gids were kept are matched on product, date and title, so they take the gid instead of
+        # being added again
+        if item_dict['gid'] is not None:
+            query = """
+            UPDATE news SET gid=:gid 
+            WHERE id == ( 
+                SELECT id FROM news 
+                WHERE product_id == :product_id AND date == :date AND title IS :title AND gid IS NULL 
+                LIMIT 1 
+            ) AND NOT EXISTS (SELECT 1 FROM news WHERE gid == :gid) 
+            """
+            self.execute(query, item_dict)
+        # news that are already stored (same gid) are updated
         query = """
-        INSERT INTO news (title, author, contents, date, timestamp, product_id, feed_name, feed_label, feed_type) 
-        VALUES (:title, :author, :contents, :date, :timestamp, :product_id, :feed_name, :feed_label, :feed_type)
+        INSERT INTO news (gid, title, author, contents, date, timestamp, product_id, feed_name, feed_label, feed_type) 
+        VALUES (:gid, :title, :author, :contents, :date, :timestamp, :product_id, :feed_name, :feed_label, :feed_type)
+        ON CONFLICT (gid) DO UPDATE SET title=excluded.title, author=excluded.author, contents=excluded.contents, 
+            date=excluded.date, feed_name=excluded.feed_name, feed_label=excluded.feed_label, feed_type=excluded.feed_type
+        RETURNING id
         """
-        news_cursor = self.execute(query, item_dict)
-        news_id = news_cursor.lastrowid
+        news_id = self.execute(query, item_dict).fetchone()[0]
 
         if 'tags' in item_dict and item_dict['tags']:
+            # link news with tags
+            query = """
+            INSERT INTO news_ntag (news_id, ntag_id) 
+            SELECT :news_id, :ntag_id 
+            WHERE NOT EXISTS (SELECT 1 FROM news_ntag WHERE news_id = :news_id AND ntag_id = :ntag_id)
+            """
             for tag in item_dict['tags']:
-                # add new tags to database
-                if tag not in tags:
-                    query = """
-                    INSERT INTO ntag (name) 
-                    VALUES (?)
-                    """
-                    ntag_cursor = self.execute(query, (tag,))
-                    ntag_id = ntag_cursor.lastrowid
-                    tags[tag] = ntag_id
-                else:
-                    ntag_id = tags[tag]
-                # link products with tags
-                query = """
-                INSERT INTO news_ntag (news_id, ntag_id) 
-                VALUES (?, ?)
-                """
-                self.execute(query, (news_id, ntag_id,))
+                self.queue(query, {'news_id': news_id, 'ntag_id': self.vocabulary_id('ntag', tag)})
+
+    def iter_news(self, product_ids=None, since=None, batch_size=1000, as_rows=False):
+        """
+        Yields news (of product_ids, dated since or later) with contents decompressed. All news are read by id,
+        news of product_ids product by product.
+        """
+        columns = """id, gid, title, author, decompress(contents) AS contents, date, timestamp, product_id, feed_name, 
+            feed_label, feed_type"""
+        since = None if since is None else str(since)
+        since_condition = '' if since is None else 'AND date >= :since'
+        if product_ids is None:
+            query = f"""
+            SELECT {columns} 
+            FROM news 
+            WHERE id > :after {since_condition} 
+            ORDER BY id 
+            LIMIT :limit
+            """
+            yield from self.iterate(query, {'since': since}, batch_size, as_rows)
+            return
+
+        query = f"""
+        SELECT {columns} 
+        FROM news 
+        WHERE product_id = :product_id {since_condition}
+        """
+        for product_id in product_ids:
+            yield from self.iterate(query, {'product_id': product_id, 'since': since}, batch_size, as_rows)
 
     def init(self, *args, **kwargs):
         pass
@@ -513,26 +1019,84 @@ class News:
     def execute(self, *args, **kwargs):
         pass
 
+    def queue(self, *args, **kwargs):
+        pass
+
+    def iterate(self, *args, **kwargs):
+        pass
+
+    def vocabulary_id(self, *args, **kwargs):
+        pass
+
+    def add_column(self, *args, **kwargs):
+        pass
+
+    def compress(self, *args, **kwargs):
+        pass
+
 
 class Database(Product, Review, News):
-    def __init__(self, sqlite_path, overwrite_db, row_factory=False):
+    # PRAGMAs for loading large amounts of data, a crash during bulk load may corrupt the database
+    bulk_load_pragmas = {
+        'journal_mode': 'OFF',
+        'synchronous': 'OFF',
+        'cache_size': -262144,
+        'temp_store': 'MEMORY',
+    }
+
+    def __init__(self, sqlite_path, overwrite_db, row_factory=False, flush_size=1, flush_interval=0,
+                 cache_size=100000, bulk_load=False):
         filename = sqlite_path
 
         if overwrite_db and os.path.exists(filename):
             os.remove(filename)
 
+        self.path = filename
         self.new = not os.path.exists(filename)
         self.db = sqlite3.connect(filename)
         if row_factory:
             self.db.row_factory = sqlite3.Row
+        # compressed columns are read with decompress(column)
+        self.compressor = Compressor()
+        self.db.create_function('decompress', 1, self.compressor.decompress, deterministic=True)
+
+        # write buffer, flushed every `flush_size` items or `flush_interval` seconds
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.pending_keys = set()
+        self.pending_items = 0
+        self.last_flush = time.monotonic()
+        self.last_ids = {}
+        # bounded caches of recently written keys, the database enforces uniqueness
+        self.rscrape_cache = LRUCache(cache_size)
+        self.user_cache = LRUCache(cache_size)
+        # name -> id of genre, spec, tag and ntag tables, loaded on first use
+        self.vocabularies = {}
+        # optional steam.writer.DatabaseWriter that owns the write connection
+        self.writer = None
+        # settings replaced during bulk load
+        self.loading = False
+        self.safe_pragmas = {}
 
         self.commit()
+        if bulk_load:
+            self.start_bulk_load()
 
         super().__init__()
         self.create_product_tables()
         self.create_review_tables()
         self.create_news_tables()
 
+        # preset dictionaries of compressed columns, see steam/compression.py
+        self.execute("""CREATE TABLE IF NOT EXISTS compression_dictionary (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    column_name TEXT NOT NULL,
+                    data BLOB,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)
+                    """)
+        self.load_dictionaries()
+
     def execute(self, *args, **kwargs):
         """ Executes database command.  """
         return self.db.execute(*args, **kwargs)
@@ -542,10 +1106,350 @@ class Database(Product, Review, News):
         if self.new:
             return self.execute(*args, **kwargs)
 
+    def submit(self, method, *args, **kwargs):
+        """ Runs write method on the writer thread (returns a Deferred) or directly if there is no writer. """
+        if self.writer:
+            return self.writer.submit(method, *args, **kwargs)
+        return getattr(self, method)(*args, **kwargs)
+
+    def queue(self, query, params):
+        """ Buffers a row for query, rows of the same query are later written with a single executemany. """
+        self.pending.setdefault(query, []).append(params)
+
+    def iterate(self, query, params, batch_size, as_rows=False):
+        """
+        Yields rows of query, batch_size at a time, as the connection returns them or with as_rows as sqlite3.Row.
+
+        A query with an :after parameter is paginated on its first column: it is run once per batch, ordered by that
+        column and limited to :limit rows, with :after set to the last value of the previous batch, so no read is
+        left open while rows are processed. Other queries are read from a single cursor with fetchmany.
+        """
+        keyset = ':after' in query
+        cursor = None
+        after = -2 ** 63
+        while True:
+            if keyset:
+                cursor = self.execute(query, {**params, 'after': after, 'limit': batch_size})
+            elif cursor is None:
+                cursor = self.execute(query, params)
+            if as_rows:
+                cursor.row_factory = sqlite3.Row
+            rows = cursor.fetchmany(batch_size)
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            after = rows[-1][0]
+
+    def add_column(self, table, column, definition):
+        """ Adds column to a table of an existing database, if it is missing. """
+        columns = [c[1] for c in self.execute(f"PRAGMA table_info({table})")]
+        if columns and column not in columns:
+            self.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def load_dictionaries(self):
+        """
+        Loads compression dictionaries, columns without one are not compressed. Full-text index triggers are updated
+        to decompress exactly the columns that have a dictionary.
+        """
+        self.compressor.load(self.execute("SELECT id, column_name, data FROM compression_dictionary").fetchall())
+        for table in self.search_tables():
+            self.create_search_triggers(table)
+
+    def add_dictionary(self, column, data):
+        """ Stores a dictionary for column ('table.column'), new values of column are compressed with it. """
+        self.execute("INSERT INTO compression_dictionary (column_name, data) VALUES (?, ?)", (column, data))
+        self.commit()
+        self.load_dictionaries()
+
+    def compress(self, column, value):
+        """ Value to store in column ('table.column'), compressed if the column has a dictionary. """
+        return self.compressor.compress(column, value)
+
+    def vocabulary_id(self, table, name):
+        """ Returns id of name in a vocabulary table (genre, spec, tag or ntag), inserting it if it is new. """
+        if table not in self.vocabularies:
+            self.vocabularies[table] = {v_name: v_id for v_id, v_name in self.execute(f"SELECT id, name FROM {table}")}
+        vocabulary = self.vocabularies[table]
+        if name not in vocabulary:
+            vocabulary[name] = self.execute(f"INSERT INTO {table} (name) VALUES (?)", (name,)).lastrowid
+        return vocabulary[name]
+
+    def next_id(self, table):
+        """
+        Reserves the next AUTOINCREMENT id of table, so queued rows can reference each other. The last id is read
+        again after every commit, ids taken by other connections in the meantime are not reused.
+        """
+        if table not in self.last_ids:
+            seq = self.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,)).fetchone()
+            max_id = self.execute(f"SELECT MAX(id) FROM {table}").fetchone()[0]
+            self.last_ids[table] = max(seq[0] if seq else 0, max_id or 0)
+        self.last_ids[table] += 1
+        return self.last_ids[table]
+
+    def maybe_commit(self):
+        """
+        Commits when at least flush_size items are queued or, if flush_interval is positive, flush_interval seconds
+        have passed since the last commit.
+        """
+        if self.pending_items >= self.flush_size or \
+                0 < self.flush_interval <= time.monotonic() - self.last_flush:
+            self.commit()
+
     def commit(self):
-        """ Commits changes. """
-        self.db.commit()
+        """
+        Writes queued rows and commits changes in a single transaction. If a row fails, e.g. because another
+        connection wrote a reserved id first, the whole transaction is rolled back and the error is raised.
+        """
+        try:
+            for query, rows in self.pending.items():
+                self.db.executemany(query, rows)
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            # cached ids may belong to rows that were rolled back
+            self.rscrape_cache.clear()
+            self.user_cache.clear()
+            self.vocabularies = {}
+            raise
+        finally:
+            self.pending = {}
+            self.pending_keys = set()
+            self.pending_items = 0
+            self.last_ids = {}
+            self.last_flush = time.monotonic()
+
+    def create_indexes(self):
+        """ Creates all secondary indexes. """
+        self.create_product_indexes()
+        self.create_review_indexes()
+        self.create_news_indexes()
+
+    def start_bulk_load(self):
+        """ Applies loading PRAGMAs and defers secondary index creation until finish_bulk_load. """
+        self.commit()
+        for pragma, value in self.bulk_load_pragmas.items():
+            self.safe_pragmas[pragma] = self.execute(f"PRAGMA {pragma}").fetchone()[0]
+            self.execute(f"PRAGMA {pragma}={value}")
+        self.loading = True
+
+    def finish_bulk_load(self):
+        """ Creates deferred indexes, updates planner statistics and restores safe PRAGMAs. """
+        self.commit()
+        logging.log(logging.INFO, 'Bulk load finished, creating indexes.')
+        self.create_indexes()
+        self.execute("ANALYZE")
+        self.commit()
+        for pragma, value in self.safe_pragmas.items():
+            self.execute(f"PRAGMA {pragma}={value}")
+        self.safe_pragmas = {}
+        self.loading = False
+
+    @contextlib.contextmanager
+    def bulk_load(self):
+        """ Context manager that runs the enclosed writes in bulk load mode. """
+        self.start_bulk_load()
+        try:
+            yield self
+        finally:
+            self.finish_bulk_load()
+
+    def table_columns(self, schema, table, exclude=()):
+        """ Columns of table that exist in this database and in the attached schema, without those in exclude. """
+        columns = [c[1] for c in self.execute(f"PRAGMA main.table_info({table})")]
+        other = {c[1] for c in self.execute(f"PRAGMA {schema}.table_info({table})")}
+        return ', '.join(c for c in columns if c in other and c not in exclude)
+
+    def seed_shard(self, sqlite_path, shard_index, shard_count):
+        """
+        Copies products with unscraped reviews and id % shard_count == shard_index from the database at sqlite_path,
+        with review pages, reviews and users of those already partially scraped. Does nothing if this database already
+        has products, so a restarted shard resumes from its own state.
+        """
+        if self.execute("SELECT 1 FROM product LIMIT 1").fetchone():
+            return
+        self.commit()
+        backlog = """
+        SELECT id 
+        FROM source.product 
+        WHERE reviews_scraped IS NULL AND NOT n_reviews IS NULL AND id % :shard_count == :shard_index
+        """
+        rows = {
+            'product': f"id IN ({backlog})",
+            'rscrape': f"product_id IN ({backlog})",
+            'user': f"id IN (SELECT user_id FROM source.review WHERE product_id IN ({backlog}))",
+            'review': f"product_id IN ({backlog})",
+            'rscrape_review': f"rscrape_id IN (SELECT id FROM source.rscrape WHERE product_id IN ({backlog}))",
+            # copied reviews are compressed with these, and so are reviews of the shard
+            'compression_dictionary': "1",
+        }
+        params = {'shard_index': shard_index, 'shard_count': shard_count}
+        self.execute("ATTACH DATABASE ? AS source", (sqlite_path,))
+        try:
+            with self.db:
+                for table, where in rows.items():
+                    columns = self.table_columns('source', table)
+                    self.execute(f"INSERT OR IGNORE INTO main.{table} ({columns}) "
+                                 f"SELECT {columns} FROM source.{table} WHERE {where}", params)
+        finally:
+            self.execute("DETACH DATABASE source")
+        self.load_dictionaries()
+
+    def merge_shard(self, path):
+        """
+        Folds the review crawl of the shard database at path into this database and returns {table: rows written}.
+
+        Review pages and reviews get new ids, they are matched by their natural keys (product_id, page) and
+        (product_id, user_id), and the links between them are mapped to the new ids. Users and reviews already in this
+        database are kept, finished products get the shard's reviews_scraped.
+        """
+        self.commit()
+        rscrape_columns = self.table_columns('main', 'rscrape', exclude=('id',))
+        review_columns = self.table_columns('main', 'review', exclude=('id',))
+        self.execute("ATTACH DATABASE ? AS shard", (path,))
+        query = """
+        SELECT COUNT(*) 
+        FROM shard.compression_dictionary AS shard_dictionary 
+            LEFT JOIN main.compression_dictionary AS dictionary ON dictionary.id == shard_dictionary.id 
+        WHERE dictionary.data IS NOT shard_dictionary.data
+        """
+        if self.execute(query).fetchone()[0]:
+            self.execute("DETACH DATABASE shard")
+            raise ValueError(f'{path} was compressed with dictionaries that are not in this database.')
+        queries = {
+            'product': """
+            UPDATE main.product 
+            SET reviews_scraped=shard_product.reviews_scraped 
+            FROM shard.product AS shard_product 
+            WHERE shard_product.id == product.id AND NOT shard_product.reviews_scraped IS NULL 
+                AND product.reviews_scraped IS NOT shard_product.reviews_scraped
+            """,
+            'user': f"""
+            INSERT OR IGNORE INTO main.user ({self.table_columns('shard', 'user')}) 
+            SELECT {self.table_columns('shard', 'user')} FROM shard.user
+            """,
+            'rscrape': f"""
+            INSERT INTO main.rscrape ({rscrape_columns}) 
+            SELECT {rscrape_columns} FROM shard.rscrape WHERE true 
+            ON CONFLICT (product_id, page) DO UPDATE SET status=excluded.status WHERE status IS NOT excluded.status
+            """,
+            'review': f"""
+            INSERT OR IGNORE INTO main.review ({review_columns}) 
+            SELECT {review_columns} FROM shard.review
+            """,
+            'rscrape_review': """
+            INSERT INTO main.rscrape_review (rscrape_id, review_id) 
+            SELECT rscrape.id, review.id 
+            FROM shard.rscrape_review AS link 
+                JOIN shard.rscrape AS shard_rscrape ON shard_rscrape.id == link.rscrape_id 
+                JOIN shard.review AS shard_review ON shard_review.id == link.review_id 
+                JOIN main.rscrape AS rscrape 
+                    ON rscrape.product_id == shard_rscrape.product_id AND rscrape.page IS shard_rscrape.page 
+                JOIN main.review AS review 
+                    ON review.product_id == shard_review.product_id AND review.user_id == shard_review.user_id 
+            WHERE NOT EXISTS (
+                SELECT 1 FROM main.rscrape_review AS existing 
+                WHERE existing.rscrape_id == rscrape.id AND existing.review_id == review.id
+            )
+            """,
+        }
+        try:
+            with self.db:
+                written = {table: self.execute(query).rowcount for table, query in queries.items()}
+        finally:
+            self.execute("DETACH DATABASE shard")
+        self.rscrape_cache.clear()
+        self.user_cache.clear()
+        return written
+
+    def create_search_index(self, tables=None):
+        """
+        Creates the FTS5 full-text index <table>_fts of tables (all in SEARCH_COLUMNS by default) and fills it.
+
+        The index has external content: it reads text through view <table>_fts_content, so text is not stored twice.
+        Triggers keep it in step with inserts, updates and deletes.
+        """
+        self.commit()
+        for table in tables or SEARCH_COLUMNS:
+            if table in self.search_tables():
+                continue
+            columns = SEARCH_COLUMNS[table]
+            self.execute(f"""CREATE VIRTUAL TABLE {table}_fts 
+                        USING fts5({', '.join(columns)}, content='{table}_fts_content', content_rowid='id')
+                        """)
+            self.create_search_triggers(table)
+            self.rebuild_search_index([table])
+
+    def create_search_triggers(self, table):
+        """
+        Creates or updates the content view and the triggers of the full-text index of table.
+
+        Only columns with a compression dictionary are read through decompress(), so as long as a table is not
+        compressed, connections without the function (e.g. the sqlite3 shell) can still write to it.
+        """
+        columns = SEARCH_COLUMNS[table]
+        # text of the columns of row prefix ('', NEW. or OLD.)
+        text = {prefix: [f'decompress({prefix}{column})' if f'{table}.{column}' in self.compressor.active
+                         else f'{prefix}{column}' for column in columns] for prefix in ('', 'NEW.', 'OLD.')}
+        content = ', '.join(f'{value} AS {column}' for value, column in zip(text[''], columns))
+        changed = ' OR '.join(f'{old} IS NOT {new}' for old, new in zip(text['OLD.'], text['NEW.']))
+        insert = (f"INSERT INTO {table}_fts (rowid, {', '.join(columns)}) "
+                  f"VALUES (NEW.id, {', '.join(text['NEW.'])});")
+        delete = (f"INSERT INTO {table}_fts ({table}_fts, rowid, {', '.join(columns)}) "
+                  f"VALUES ('delete', OLD.id, {', '.join(text['OLD.'])});")
+        # values rewritten by compression keep their text and are not indexed again
+        statements = {
+            ('view', f'{table}_fts_content'): f"CREATE VIEW {table}_fts_content AS SELECT id, {content} FROM {table}",
+            ('trigger', f'{table}_fts_insert'):
+                f"CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN {insert} END",
+            ('trigger', f'{table}_fts_delete'):
+                f"CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN {delete} END",
+            ('trigger', f'{table}_fts_update'):
+                f"CREATE TRIGGER {table}_fts_update AFTER UPDATE OF {', '.join(columns)} ON {table} WHEN {changed} "
+                f"BEGIN {delete} {insert} END",
+        }
+        for (kind, name), statement in statements.items():
+            row = self.execute("SELECT sql FROM sqlite_master WHERE type=? AND name=?", (kind, name)).fetchone()
+            if row and row[0] == statement:
+                continue
+            if row:
+                self.execute(f"DROP {kind.upper()} {name}")
+            self.execute(statement)
+        self.commit()
+
+    def rebuild_search_index(self, tables=None):
+        """ Rebuilds the full-text index of tables (all indexed tables by default) from their content. """
+        self.commit()
+        for table in tables or self.search_tables():
+            self.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+            self.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('optimize')")
+            self.commit()
+
+    def drop_search_index(self, tables=None):
+        """ Removes the full-text index of tables (all indexed tables by default) with its triggers. """
+        self.commit()
+        for table in tables or self.search_tables():
+            for event in ('insert', 'delete', 'update'):
+                self.execute(f"DROP TRIGGER IF EXISTS {table}_fts_{event}")
+            self.execute(f"DROP TABLE IF EXISTS {table}_fts")
+            self.execute(f"DROP VIEW IF EXISTS {table}_fts_content")
+        self.commit()
+
+    def search_tables(self):
+        """ Tables that have a full-text index. """
+        names = {name for name, in self.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        return [table for table in SEARCH_COLUMNS if f'{table}_fts' in names]
+
+    def search(self, table, query, limit=100):
+        """ Ids of rows of table matching FTS5 query, best match first. """
+        if table not in SEARCH_COLUMNS:
+            raise ValueError(f'Table {table} has no full-text index, indexed tables: {", ".join(SEARCH_COLUMNS)}')
+        self.commit()
+        sql = f"SELECT rowid FROM {table}_fts WHERE {table}_fts MATCH ? ORDER BY rank LIMIT ?"
+        return [row_id for row_id, in self.execute(sql, (query, -1 if limit is None else limit))]
 
     def close(self):
-        """ Close connection. """
+        """ Commits queued rows and closes connection. """
+        if self.loading:
+            self.finish_bulk_load()
+        self.commit()
         self.db.close()
@@ -0,0 +1,137 @@
+"""
+Background writer that owns the SQLite write connection.
+"""
+import logging
+import queue
+import threading
+import time
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from .sqlite import Database
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseWriter(threading.Thread):
+    """
+    Runs Database write methods on a single background thread.
+
+    At most queue_size jobs are handed over to the thread at a time. Further jobs wait in the reactor for a free
+    slot without blocking it; every job returns a Deferred that fires once it has been written, so items held back
+    this way slow Scrapy down to the writer's pace. If the writer database cannot be opened, all jobs fail with
+    that error.
+    """
+    def __init__(self, sqlite_path, queue_size=1000, stats=None, **db_kwargs):
+        super().__init__(name='sqlite-writer', daemon=True)
+        self.sqlite_path = sqlite_path
+        self.db_kwargs = db_kwargs
+        # bounds the jobs handed over to the thread, the queue itself never blocks the reactor
+        self.slots = defer.DeferredSemaphore(queue_size)
+        self.jobs = queue.Queue()
+        self.stats = stats
+        self.stopped = defer.Deferred()
+        # Failure that stopped the writer thread, new jobs fail right away
+        self.failure = None
+        self.writes = 0
+        self.write_time = 0.0
+
+    def submit(self, method, *args, **kwargs):
+        """ Schedules db.method(*args, **kwargs) on the writer thread and returns a Deferred with its result. """
+        d = defer.Deferred()
+        self.slots.acquire().addCallback(lambda _: self.put((method, args, kwargs, d)))
+        return d
+
+    def stop(self):
+        """ Writes remaining jobs, commits, closes the writer connection and returns a Deferred. """
+        if self.is_alive():
+            # queued behind the jobs still waiting for a slot; a failed writer keeps taking jobs until it gets this one
+            self.slots.acquire().addCallback(lambda _: self.jobs.put(None))
+        else:
+            self.finish(self.failure)
+        return self.stopped
+
+    def put(self, job):
+        """ Called in the reactor thread once job holds a slot, hands it over to the writer thread. """
+        if self.failure is not None or not self.is_alive():
+            self.job_failed(job[3])
+            return
+        self.jobs.put(job)
+        self.set_stats()
+
+    def set_stats(self):
+        if not self.stats:
+            return
+        depth = self.jobs.qsize()
+        self.stats.set_value('sqlite_writer/queue_depth', depth)
+        self.stats.max_value('sqlite_writer/queue_depth_max', depth)
+        self.stats.set_value('sqlite_writer/waiting', len(self.slots.waiting))
+        if self.writes:
+            self.stats.set_value('sqlite_writer/writes', self.writes)
+            self.stats.set_value('sqlite_writer/latency_avg_ms', round(1000 * self.write_time / self.writes, 3))
+
+    def job_done(self, d, result, elapsed):
+        """ Called in the reactor thread after a job was executed. """
+        self.slots.release()
+        self.writes += 1
+        self.write_time += elapsed
+        if self.stats:
+            self.stats.max_value('sqlite_writer/latency_max_ms', round(1000 * elapsed, 3))
+        self.set_stats()
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def job_failed(self, d):
+        """ Called in the reactor thread for a job that was not executed because the writer is not running. """
+        self.slots.release()
+        d.errback(self.failure or RuntimeError('SQLite writer is not running'))
+
+    def finish(self, failure=None):
+        """ Called in the reactor thread when the writer thread ends. """
+        if self.stats:
+            self.stats.set_value('sqlite_writer/queue_depth', 0)
+            self.stats.set_value('sqlite_writer/waiting', 0)
+        if self.stopped.called:
+            return
+        if failure:
+            self.stopped.errback(failure)
+        else:
+            self.stopped.callback(None)
+
+    def run(self):
+        from twisted.internet import reactor
+
+        try:
+            db = Database(self.sqlite_path, False, **self.db_kwargs)
+        except Exception:  # noqa E722
+            logger.exception('Opening writer database failed!')
+            self.failure = Failure()
+            # fail queued jobs and those submitted before the failure was seen, until stop
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    break
+                reactor.callFromThread(self.job_failed, job[3])
+            reactor.callFromThread(self.finish, self.failure)
+            return
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            method, args, kwargs, d = job
+            start = time.monotonic()
+            try:
+                result = getattr(db, method)(*args, **kwargs)
+            except Exception:  # noqa E722
+                result = Failure()
+            reactor.callFromThread(self.job_done, d, result, time.monotonic() - start)
+
+        try:
+            db.close()
+        except Exception:  # noqa E722
+            logger.exception('Closing writer database failed!')
+        reactor.callFromThread(self.finish)